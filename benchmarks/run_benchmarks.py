@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the SpyBOAT processing pipeline on synthetic movies.
+
+Every benchmark gets repeated and the fastest run is reported,
+together with its throughput in pixels (time series) per second
+and the peak memory of the numpy allocations. The parallel transforms
+additionally report the scaling efficiency with respect to n_cpu = 1
+and the peak RSS of the worker processes.
+
+Example
+-------
+
+python run_benchmarks.py --shape 120 64 64 --ncpu 1 2 4 --json_out new.json
+python run_benchmarks.py --shape 120 64 64 --ncpu 1 2 4 --baseline new.json
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import spyboat
+from spyboat import profiling
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+logger = logging.getLogger('spyboat-bench')
+
+# relative slowdown with respect to the baseline which gets flagged
+REGRESSION_TOLERANCE = 0.1
+
+
+def synthetic_movie(Nt, ydim, xdim, dt=1, Tmin=20, Tmax=30, noise=0.5,
+                    trend=True, seed=42):
+
+    '''
+    Creates an oscillatory movie with shape (Nt, ydim, xdim), the
+    periods vary linearly from *Tmin* to *Tmax* along the x-axis,
+    the phases along the y-axis. Optionally with a linear trend,
+    a decaying amplitude and additive white noise. The left and right
+    border columns are pure noise background, e.g. to be masked.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    tvec = np.arange(Nt)[:, None, None] * dt
+    periods = np.linspace(Tmin, Tmax, xdim)[None, None, :]
+    phases = np.linspace(0, np.pi, ydim)[None, :, None]
+    envelope = np.exp(-tvec / (Nt * dt))
+
+    movie = 10 + 5 * envelope * np.cos(2 * np.pi / periods * tvec + phases)
+    if trend:
+        movie = movie + tvec / (Nt * dt) * 5
+    movie = movie + noise * rng.standard_normal((Nt, ydim, xdim))
+
+    # background
+    border = max(1, xdim // 8)
+    movie[..., :border] = noise * rng.standard_normal((Nt, ydim, border))
+    movie[..., -border:] = noise * rng.standard_normal((Nt, ydim, border))
+
+    return movie.astype(np.float32)
+
+
+def measure(func, repeats, pixels):
+
+    '''
+    Calls *func* *repeats* times, returns the record of the fastest
+    call and the result of the last call.
+    '''
+
+    best = None
+    for _ in range(repeats):
+        profiling.reset()
+        tracemalloc.start()
+        cpu0, wall0 = time.process_time(), time.perf_counter()
+        result = func()
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+        if best is None or wall < best['wall_s']:
+            workers = profiling.summary()['workers']
+            best = {'wall_s': wall,
+                    'cpu_s': cpu,
+                    'pixels': pixels,
+                    'pixels_per_s': pixels / wall,
+                    'peak_alloc_mb': peak}
+            if workers:
+                best['worker_peak_rss_mb'] = max(w['peak_rss_mb'] or 0
+                                                 for w in workers)
+    return best, result
+
+
+def refinement_accuracy(coarse_nTs=(25, 50, 100), dense_nT=400):
+
+    '''
+    Deviations of the ridge periods on coarse period grids, with and
+    without sub-grid refinement (`refine_ridge`), from the refined
+    ones on a dense grid for the `two_sines` test movie. Only pixels whose
+    dense ridge lies inside the period range are compared.
+    '''
+
+    movie = spyboat.datasets.two_sines
+    Wkwargs = {'dt': 1, 'Tmin': 20, 'Tmax': 60, 'T_c': 80}
+
+    dense = spyboat.transform_stack(movie, nT=dense_nT, refine_ridge=True,
+                                    **Wkwargs)['period']
+    step = (Wkwargs['Tmax'] - Wkwargs['Tmin']) / (dense_nT - 1)
+    inside = (dense > Wkwargs['Tmin'] + step) & (dense < Wkwargs['Tmax'] - step)
+
+    records = {}
+    for nT in coarse_nTs:
+        for refine in (False, True):
+            periods = spyboat.transform_stack(movie, nT=nT, refine_ridge=refine,
+                                              **Wkwargs)['period']
+            dev = np.abs(periods - dense)[inside]
+            name = f"nT{nT}{'_refined' if refine else ''}"
+            records[name] = {'median': float(np.median(dev)),
+                             'p99': float(np.percentile(dev, 99))}
+            logger.info(f"{name:<28} period deviation median {records[name]['median']:.4f}, "
+                        f"99th percentile {records[name]['p99']:.4f}")
+
+    return records
+
+
+def run_benchmarks(args):
+
+    Nt, ydim, xdim = args.shape
+    Npix = ydim * xdim
+    Wkwargs = {'dt': 1,
+               'Tmin': 20,
+               'Tmax': 30,
+               'nT': args.nT,
+               'T_c': args.Tcutoff,
+               'win_size': args.win_size}
+
+    logger.info(f'Synthetic movie with shape {args.shape}')
+    movie = synthetic_movie(Nt, ydim, xdim)
+
+    # keep the library quiet, the per stage logs would dominate the output
+    for module in (spyboat.processing, spyboat.util, spyboat.io):
+        module.logger.setLevel(logging.WARNING)
+    # worker statistics are needed for their peak memory
+    profiling.enable()
+
+    records = {}
+
+    def bench(name, func, pixels=Npix):
+        record, result = measure(func, args.repeats, pixels)
+        records[name] = record
+        logger.info(f"{name:<28} {record['wall_s']:8.3f}s "
+                    f"{record['pixels_per_s']:12.1f} pixels/s "
+                    f"{record['peak_alloc_mb']:8.1f}MB")
+        return result
+
+    # --- preprocessing ---
+    bench('down_sample', lambda: spyboat.down_sample(movie, 0.5))
+    bench('gaussian_blur', lambda: spyboat.gaussian_blur(movie, 1.5))
+
+    # --- masking ---
+    static_mask = bench('create_static_mask',
+                        lambda: spyboat.create_static_mask(movie, 0, 2))
+    bench('create_dynamic_mask',
+          lambda: spyboat.create_dynamic_mask(movie, 2))
+
+    # --- transforms ---
+    results = bench('transform_stack',
+                    lambda: spyboat.transform_stack(movie, **Wkwargs))
+    bench('transform_stack_refined',
+          lambda: spyboat.transform_stack(movie, refine_ridge=True,
+                                          **dict(Wkwargs, nT=args.nT // 4)))
+    bench('transform_stack_streaming',
+          lambda: spyboat.transform_stack(movie, period_block=16, **Wkwargs))
+    bench('transform_stack_masked',
+          lambda: spyboat.transform_stack(movie, mask=static_mask,
+                                          **Wkwargs),
+          pixels=int(np.count_nonzero(~static_mask)))
+
+    for n_cpu in args.ncpu:
+        bench(f'run_parallel_ncpu{n_cpu}',
+              lambda: spyboat.run_parallel(movie, n_cpu,
+                                           chunk_size=args.chunk_size,
+                                           **Wkwargs))
+
+    # scaling with respect to a single process
+    if 1 in args.ncpu:
+        serial = records['run_parallel_ncpu1']['wall_s']
+        for n_cpu in args.ncpu:
+            record = records[f'run_parallel_ncpu{n_cpu}']
+            record['speedup'] = serial / record['wall_s']
+            record['scaling_efficiency'] = record['speedup'] / n_cpu
+
+    # --- output ---
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench('save_results_to_tifs',
+              lambda: spyboat.save_results_to_tifs(results, 'bench', tmp_dir))
+
+    profiling.disable()
+
+    # --- accuracy of the sub-grid ridge refinement ---
+    logger.info('Ridge periods on coarse grids vs. nT = 400 for two_sines:')
+    accuracy = refinement_accuracy()
+
+    return {'spyboat_version': spyboat.__version__,
+            'numpy_version': np.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'shape': list(args.shape),
+            'Wkwargs': Wkwargs,
+            'repeats': args.repeats,
+            'benchmarks': records,
+            'refinement_accuracy': accuracy}
+
+
+def compare(run, baseline, tolerance=REGRESSION_TOLERANCE):
+
+    '''
+    Logs the speedup of every benchmark of *run* with respect to
+    the *baseline*, returns the names of the benchmarks which
+    got slower by more than the relative *tolerance*.
+    '''
+
+    if run['shape'] != baseline['shape'] or run['Wkwargs'] != baseline['Wkwargs']:
+        logger.warning('Baseline was run with different settings, '
+                       'comparison is not meaningful!')
+
+    logger.info(f"Comparison to baseline (spyboat {baseline['spyboat_version']}):")
+    regressions = []
+    for name, record in run['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        base = baseline['benchmarks'][name]
+        speedup = base['wall_s'] / record['wall_s']
+        mem_ratio = record['peak_alloc_mb'] / max(base['peak_alloc_mb'], 1e-6)
+        flag = ''
+        if speedup < 1 - tolerance:
+            flag = ' <-- slower'
+            regressions.append(name)
+        logger.info(f'{name:<28} speedup {speedup:6.2f}x, '
+                    f'memory {mem_ratio:6.2f}x{flag}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks SpyBOAT on synthetic movies.')
+
+    parser.add_argument('--shape', help='Shape (Frames, Y, X) of the synthetic movie',
+                        nargs=3, type=int, default=[100, 48, 48])
+    parser.add_argument('--nT', help='Number of periods to scan for', type=int, default=100)
+    parser.add_argument('--Tcutoff', help='Sinc cut-off period, None disables detrending',
+                        type=float, default=40)
+    parser.add_argument('--win_size', help='Sliding window size for amplitude normalization, None disables',
+                        type=float, default=30)
+    parser.add_argument('--ncpu', help='Numbers of processors to benchmark run_parallel with',
+                        nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--chunk_size', help='Tile size for run_parallel, None means one tile per processor',
+                        type=int)
+    parser.add_argument('--repeats', help='Number of repetitions per benchmark, the fastest counts',
+                        type=int, default=3)
+    parser.add_argument('--json_out', help='Store the results as json, e.g. to serve as a baseline',
+                        type=str)
+    parser.add_argument('--baseline', help='Json results of a previous run to compare against',
+                        type=str)
+    parser.add_argument('--tolerance', help='Relative slowdown with respect to the baseline which counts as regression',
+                        type=float, default=REGRESSION_TOLERANCE)
+
+    args = parser.parse_args()
+
+    run = run_benchmarks(args)
+
+    if args.json_out is not None:
+        with open(args.json_out, 'w') as OUT:
+            json.dump(run, OUT, indent=2)
+        logger.info(f'Written benchmark results to {args.json_out}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as IN:
+            baseline = json.load(IN)
+        regressions = compare(run, baseline, args.tolerance)
+        if regressions:
+            logger.warning(f'Slower than baseline: {", ".join(regressions)}')
+            sys.exit(1)
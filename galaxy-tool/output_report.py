@@ -1,6 +1,7 @@
 """ Produces plots and a summary html 'headless' """
 import logging
 import os
+import multiprocessing as mp
 
 import matplotlib
 import matplotlib.pyplot as ppl
@@ -13,8 +14,22 @@ logger = logging.getLogger(__name__)
 # figure resolution
 DPI = 250
 
+# fast snapshots get enlarged by repeating pixels up to this size,
+# so the browser doesn't blur small frames
+FAST_MIN_SIZE = 400
 
-def produce_snapshots(input_movie, results, frame, Wkwargs, img_path="."):
+# colormaps and value ranges of the fast snapshots,
+# the same as for the spyboat.plotting snapshots
+FAST_STYLES = {
+    "input": ("cividis", None, None),
+    "phase": ("bwr", 0, 6.2832),
+    "period": ("magma_r", "Tmin", "Tmax"),
+    "amplitude": ("copper", 0, None),
+}
+
+
+def produce_snapshots(input_movie, results, frame, Wkwargs, img_path=".",
+                      fast=False):
     """
     Takes the *input_movie* and the *results* dictionary
     from spyboat.processing.run_parallel and produces phase,
@@ -27,39 +42,98 @@ def produce_snapshots(input_movie, results, frame, Wkwargs, img_path="."):
     [input, phase, period, amplitude]_frame{frame}.png
     and the storage location in *img_path*.
 
+    With *fast* the frames get colormapped and written
+    directly as png's at their original resolution,
+    without a matplotlib figure (and colorbar) each.
+
     These get picked up by 'create_html'
     """
 
-    spyplot.input_snapshot(input_movie[frame])
-    fig = ppl.gcf()
-    out_path = os.path.join(img_path, f"input_frame{frame}.png")
-    fig.savefig(out_path, dpi=DPI)
-    ppl.close(fig)
+    _render_snapshots(frame, _snapshot_frames(input_movie, results, frame),
+                      (Wkwargs["Tmin"], Wkwargs["Tmax"]), img_path, fast)
 
-    spyplot.phase_snapshot(results["phase"][frame])
-    fig = ppl.gcf()
-    out_path = os.path.join(img_path, f"phase_frame{frame}.png")
-    fig.savefig(out_path, dpi=DPI)
-    ppl.close(fig)
 
-    spyplot.period_snapshot(
-        results["period"][frame], Wkwargs["Tmin"],
-        Wkwargs["Tmax"], time_unit="a.u."
-    )
+def produce_all_snapshots(input_movie, results, frames, Wkwargs,
+                          img_path=".", n_cpu=1, fast=False):
+    """
+    Produces the snapshots of all *frames* like 'produce_snapshots',
+    rendered in parallel by *n_cpu* worker processes. Only the
+    snapshot frames get send to the workers.
+    """
 
-    fig = ppl.gcf()
-    out_path = os.path.join(img_path, f"period_frame{frame}.png")
-    fig.savefig(out_path, dpi=DPI)
-    ppl.close(fig)
+    period_range = (Wkwargs["Tmin"], Wkwargs["Tmax"])
+    tasks = [(frame, _snapshot_frames(input_movie, results, frame),
+              period_range, img_path, fast) for frame in frames]
+
+    n_cpu = max(1, min(n_cpu, len(tasks)))
+    if n_cpu == 1:
+        for task in tasks:
+            _render_snapshots(*task)
+        return
+
+    with mp.Pool(n_cpu) as pool:
+        # consume to surface errors of the workers
+        for _ in pool.imap_unordered(_star_render_snapshots, tasks):
+            pass
+
+
+def _snapshot_frames(input_movie, results, frame):
+
+    frames = {key: results[key][frame] for key in ("phase", "period", "amplitude")}
+    frames["input"] = input_movie[frame]
+    return frames
+
+
+def _render_snapshots(frame, snapshots, period_range, img_path, fast):
+
+    if fast:
+        limits = {"Tmin": period_range[0], "Tmax": period_range[1]}
+        for key, (cmap, vmin, vmax) in FAST_STYLES.items():
+            out_path = os.path.join(img_path, f"{key}_frame{frame}.png")
+            _fast_snapshot(snapshots[key], out_path, cmap,
+                           limits.get(vmin, vmin), limits.get(vmax, vmax))
+    else:
+        spyplot.input_snapshot(snapshots["input"])
+        _save_figure(os.path.join(img_path, f"input_frame{frame}.png"))
+
+        spyplot.phase_snapshot(snapshots["phase"])
+        _save_figure(os.path.join(img_path, f"phase_frame{frame}.png"))
+
+        spyplot.period_snapshot(snapshots["period"], *period_range,
+                                time_unit="a.u.")
+        _save_figure(os.path.join(img_path, f"period_frame{frame}.png"))
+
+        spyplot.amplitude_snapshot(snapshots["amplitude"])
+        _save_figure(os.path.join(img_path, f"amplitude_frame{frame}.png"))
+
+    logger.info(f"Produced 4 snapshots for frame {frame}..")
+
+
+def _star_render_snapshots(args):
+    return _render_snapshots(*args)
+
+
+def _fast_snapshot(snapshot, out_path, cmap, vmin=None, vmax=None):
+    """
+    Writes the colormapped *snapshot* directly as png,
+    masked pixels (below *vmin*) and NaNs are gray.
+    """
+
+    scale = max(1, FAST_MIN_SIZE // max(snapshot.shape))
+    if scale > 1:
+        snapshot = snapshot.repeat(scale, axis=0).repeat(scale, axis=1)
+
+    cmap = matplotlib.colormaps[cmap].with_extremes(under="gray", bad="gray")
+    ppl.imsave(out_path, snapshot, cmap=cmap, vmin=vmin, vmax=vmax)
+
+
+def _save_figure(out_path):
+    """ Saves and closes the current figure """
 
-    spyplot.amplitude_snapshot(results["amplitude"][frame])
     fig = ppl.gcf()
-    out_path = os.path.join(img_path, f"amplitude_frame{frame}.png")
     fig.savefig(out_path, dpi=DPI)
     ppl.close(fig)
 
-    logger.info(f"Produced 4 snapshots for frame {frame}..")
-
 
 def produce_distr_plots(results, Wkwargs, img_path="."):
     """
@@ -69,19 +143,13 @@ def produce_distr_plots(results, Wkwargs, img_path="."):
     """
 
     spyplot.period_distr_dynamics(results["period"], Wkwargs)
-    fig = ppl.gcf()
-    out_path = os.path.join(img_path, "period_distr.png")
-    fig.savefig(out_path, dpi=DPI)
+    _save_figure(os.path.join(img_path, "period_distr.png"))
 
     spyplot.power_distr_dynamics(results["power"], Wkwargs)
-    fig = ppl.gcf()
-    out_path = os.path.join(img_path, "power_distr.png")
-    fig.savefig(out_path, dpi=DPI)
+    _save_figure(os.path.join(img_path, "power_distr.png"))
 
     spyplot.phase_coherence_dynamics(results["phase"], Wkwargs)
-    fig = ppl.gcf()
-    out_path = os.path.join(img_path, "phase_distr.png")
-    fig.savefig(out_path, dpi=DPI)
+    _save_figure(os.path.join(img_path, "phase_distr.png"))
 
     logger.info("Produced 3 distribution plots..")
 
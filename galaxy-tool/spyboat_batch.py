@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Batch version of spyboat_cli.py: analyzes many movies with the same
+# parameters and a single pool of worker processes
+import argparse
+import logging
+import sys
+
+import spyboat
+from spyboat import profiling
+from spyboat.batch import run_batch, read_manifest, expand_inputs
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+logger = logging.getLogger('spyboat-batch')
+
+
+def threshold(value):
+
+    ''' Numeric thresholds, or 'Otsu' '''
+
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+# ----------command line parameters ---------------
+
+parser = argparse.ArgumentParser(description='Analyzes many movies with the same parameters.')
+
+# I/O
+parser.add_argument('--inputs', help="Glob pattern(s) of the input tifs, quote them to keep the shell from expanding",
+                    nargs='+', required=False)
+parser.add_argument('--manifest', help="Text file listing the input tifs, one per line",
+                    required=False, type=str)
+parser.add_argument('--out_dir', help="Output directory for the result tifs and the summary",
+                    required=True, type=str)
+parser.add_argument('--summary_fname', help="Name of the summary table (csv) in the output directory",
+                    default='summary.csv', required=False, type=str)
+
+# Multiprocessing
+parser.add_argument('--ncpu', help='Number of processors to use',
+                    required=False, type=int, default=1)
+parser.add_argument('--chunk_size', help='Size of the square tiles handed out to the processors, None means one tile per processor',
+                    required=False, type=int)
+parser.add_argument('--single_precision', help='Compute in single instead of double precision',
+                    required=False, action='store_true')
+parser.add_argument('--period_block', help='Transform the periods in blocks of this size and keep only the ridge',
+                    required=False, type=int)
+parser.add_argument('--refine_ridge', help='Refine the ridge periods between the scanned periods',
+                    required=False, action='store_true')
+
+# Preprocessing
+parser.add_argument('--rescale_factor', help='Rescale the image by a factor given in %%, None means no rescaling',
+                    required=False, type=int)
+parser.add_argument('--gauss_sigma', help='Gaussian smoothing parameter, None means no smoothing', required=False,
+                    type=float)
+
+# Wavelet Analysis Parameters
+parser.add_argument('--dt', help='Sampling interval', required=True, type=float)
+parser.add_argument('--Tmin', help='Smallest period', required=True, type=float)
+parser.add_argument('--Tmax', help='Biggest period', required=True, type=float)
+parser.add_argument('--nT', help='Number of periods to scan for', required=True, type=int)
+parser.add_argument('--Tcutoff', help='Sinc cut-off period, disables detrending if not set', required=False, type=float)
+parser.add_argument('--win_size', help='Sliding window size for amplitude normalization, None means no normalization',
+                    required=False, type=float)
+
+# Masking
+parser.add_argument('--masking', help="Set to either 'dynamic', 'static' or 'None' which is the default",
+                    default='None', required=False, type=str)
+parser.add_argument('--mask_frame', help="The frame to create a static mask from, needs masking set to 'static'",
+                    required=False, type=int)
+parser.add_argument('--mask_thresh', help="The threshold of the mask, a number or 'Otsu'",
+                    required=False, type=threshold, default=0)
+
+# optional result cache
+parser.add_argument('--cache_dir', help="Directory of the result cache, None disables caching",
+                    required=False, type=str)
+parser.add_argument('--cache_max_gb', help="Size limit of the result cache in GB",
+                    required=False, type=float, default=16)
+
+# optional profiling
+parser.add_argument('--profile_json', help="Write per stage timings, CPU times, peak memory and throughputs to this json file",
+                    required=False, type=str)
+
+arguments = parser.parse_args()
+
+logger.info("Received following arguments:")
+for arg in vars(arguments):
+    logger.info(f'{arg} -> {getattr(arguments, arg)}')
+
+if arguments.profile_json is not None:
+    profiling.enable()
+
+input_paths = []
+if arguments.inputs:
+    input_paths += expand_inputs(arguments.inputs)
+if arguments.manifest is not None:
+    input_paths += [path for path in read_manifest(arguments.manifest)
+                    if path not in input_paths]
+if not input_paths:
+    logger.critical('No input movies given, use --inputs and/or --manifest!')
+    sys.exit(1)
+
+Wkwargs = {'dt': arguments.dt,
+           'Tmin': arguments.Tmin,
+           'Tmax': arguments.Tmax,
+           'nT': arguments.nT,
+           'T_c': arguments.Tcutoff,  # defaults to None
+           'win_size': arguments.win_size  # defaults to None
+           }
+
+cache = None
+if arguments.cache_dir is not None:
+    cache = spyboat.ResultCache(arguments.cache_dir,
+                                int(arguments.cache_max_gb * 2**30))
+
+masking = arguments.masking if arguments.masking in ('static', 'dynamic') else None
+
+summary = run_batch(input_paths, arguments.out_dir, arguments.ncpu, Wkwargs,
+                    rescale_factor=arguments.rescale_factor,
+                    gauss_sigma=arguments.gauss_sigma,
+                    masking=masking,
+                    mask_frame=arguments.mask_frame,
+                    mask_thresh=arguments.mask_thresh,
+                    summary_fname=arguments.summary_fname,
+                    chunk_size=arguments.chunk_size,
+                    cache=cache,
+                    precision='single' if arguments.single_precision else 'double',
+                    period_block=arguments.period_block,
+                    refine_ridge=arguments.refine_ridge)
+
+if arguments.profile_json is not None:
+    profiling.log_summary()
+    profiling.write_json(arguments.profile_json)
+
+# non-zero exit if any movie failed
+if any(row['status'] != 'ok' for row in summary):
+    sys.exit(1)
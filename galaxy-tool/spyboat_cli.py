@@ -8,8 +8,10 @@ import sys
 
 import output_report
 import spyboat
-from numpy import float32
+from numpy import float32, float64
 from skimage import io
+from spyboat import profiling
+from spyboat.checkpoint import clear_checkpoint
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
 logger = logging.getLogger('spyboat-cli')
@@ -25,12 +27,25 @@ parser.add_argument('--period_out', help='Period output file name', required=Fal
 parser.add_argument('--power_out', help='Power output file name', required=False)
 parser.add_argument('--amplitude_out', help='Amplitude output file name', required=False)
 parser.add_argument('--preprocessed_out', help="Preprocessed-input output file name", required=False)
+parser.add_argument('--store_out', help="Zarr store holding all output movies and the parameters, needs zarr", required=False)
 
 # (Optional) Multiprocessing
 
 parser.add_argument('--ncpu', help='Number of processors to use',
                     required=False, type=int, default=1)
 
+parser.add_argument('--chunk_size', help='Size of the square tiles handed out to the processors, None means one tile per processor',
+                    required=False, type=int)
+
+parser.add_argument('--single_precision', help='Compute in single instead of double precision, faster and needs less memory. The deviations from double precision get logged for a sample of pixels.',
+                    required=False, action='store_true')
+
+parser.add_argument('--period_block', help='Transform the periods in blocks of this size and keep only the ridge, needs less memory for many periods. None means all periods at once',
+                    required=False, type=int)
+
+parser.add_argument('--refine_ridge', help='Refine the ridge periods between the scanned periods, gives smooth period readouts already for a small nT',
+                    required=False, action='store_true')
+
 # Optional spatial downsampling
 parser.add_argument('--rescale_factor', help='Rescale the image by a factor given in %%, None means no rescaling',
                     required=False, type=int)
@@ -68,6 +83,25 @@ parser.add_argument('--html_fname', help="Name of the html report.",
 parser.add_argument('--report_img_path', help="For the html report, to be set in Galaxy. Without galaxy leave at cwd!",
                     default='.', required=False, type=str)
 
+parser.add_argument('--fast_report', help="Write the snapshots directly as colormapped png's without matplotlib figures, much faster but without colorbars",
+                    required=False, action='store_true')
+
+# optional result cache
+parser.add_argument('--cache_dir', help="Directory of the result cache, reruns with the same input and parameters get loaded from there. None disables caching",
+                    required=False, type=str)
+parser.add_argument('--cache_max_gb', help="Size limit of the result cache in GB, the least recently used results get evicted",
+                    required=False, type=float, default=16)
+
+# optional checkpointing of long runs
+parser.add_argument('--checkpoint_dir', help="Directory to store finished tiles in right away, gets removed after success. None disables checkpointing",
+                    required=False, type=str)
+parser.add_argument('--resume', help="Resume an interrupted run from its checkpoint directory, needs the same input and parameters",
+                    required=False, action='store_true')
+
+# optional profiling
+parser.add_argument('--profile_json', help="Write per stage timings, CPU times, peak memory and throughputs to this json file",
+                    required=False, type=str)
+
 parser.add_argument('--version', action='version', version='0.1.0')
 
 arguments = parser.parse_args()
@@ -76,15 +110,21 @@ logger.info("Received following arguments:")
 for arg in vars(arguments):
     logger.info(f'{arg} -> {getattr(arguments, arg)}')
 
+if arguments.profile_json is not None:
+    profiling.enable()
+
 # ------------Read the input----------------------------------------
 try:
     movie = spyboat.open_tif(arguments.input_path)
 except FileNotFoundError:
     logger.critical(f"Couldn't open {arguments.input_path}, check movie storage directory!")
     sys.exit(1)
-# problems get logged in 'open_tif'
-if movie is None:
+except ValueError as e:
+    logger.critical(e)
     sys.exit(1)
+# single precision preprocessing only if requested, it changes the results
+prep_dtype = float32 if arguments.single_precision else float64
+
 # -------- Do (optional) spatial downsampling ---------------------------
 
 scale_factor = arguments.rescale_factor
@@ -95,7 +135,7 @@ if not scale_factor:
 
 elif 0 < scale_factor < 100:
     logger.info(f'Downsampling the movie to {scale_factor:d}% of its original size..')
-    movie = spyboat.down_sample(movie, scale_factor / 100)
+    movie = spyboat.down_sample(movie, scale_factor / 100, dtype=prep_dtype)
 else:
     raise ValueError('Scale factor must be between 0 and 100!')
 
@@ -108,7 +148,7 @@ if not arguments.gauss_sigma:
 else:
     logger.info(f'Pre-smoothing the movie with Gaussians, sigma = {arguments.gauss_sigma:.2f}..')
 
-    movie = spyboat.gaussian_blur(movie, arguments.gauss_sigma)
+    movie = spyboat.gaussian_blur(movie, arguments.gauss_sigma, dtype=prep_dtype)
 
 # ----- Set up Masking before processing ----
 
@@ -128,7 +168,9 @@ if arguments.masking == 'static':
                                           arguments.mask_thresh)
 elif arguments.masking == 'dynamic':
     logger.info(f'Creating dynamic mask with threshold {arguments.mask_thresh}')
-    mask = spyboat.create_dynamic_mask(movie, arguments.mask_thresh)
+    # packed, only the tiles of the workers get unpacked
+    mask = spyboat.create_dynamic_mask(movie, arguments.mask_thresh,
+                                       packed=True)
 
 else:
     logger.info('No masking requested..')
@@ -145,15 +187,25 @@ Wkwargs = {'dt': arguments.dt,
 
 # --- start parallel processing ---
 
-results = spyboat.run_parallel(movie, arguments.ncpu, **Wkwargs)
-
-# --- masking? ---
-
-if mask is not None:
-    # mask all output movies (in place!)
-    for key in results:
-        logger.info(f'Masking {key}')
-        spyboat.apply_mask(results[key], mask, fill_value=-1)
+cache = None
+if arguments.cache_dir is not None:
+    cache = spyboat.ResultCache(arguments.cache_dir,
+                                int(arguments.cache_max_gb * 2**30))
+
+precision = 'single' if arguments.single_precision else 'double'
+if arguments.single_precision:
+    spyboat.check_precision(movie, mask=mask, **Wkwargs)
+
+# masked pixels don't get transformed, but set to -1 directly
+results = spyboat.run_parallel(movie, arguments.ncpu,
+                               chunk_size=arguments.chunk_size,
+                               mask=mask, fill_value=-1,
+                               precision=precision,
+                               period_block=arguments.period_block,
+                               refine_ridge=arguments.refine_ridge,
+                               cache=cache,
+                               checkpoint_dir=arguments.checkpoint_dir,
+                               resume=arguments.resume, **Wkwargs)
 
 # --- Produce Output HTML Report Figures/png's ---
 
@@ -187,38 +239,55 @@ try:
             continue
         par_str += f'{arg} -> {getattr(arguments, arg)}\n'
 
-    for snapshot_frame in snapshot_frames:
-        output_report.produce_snapshots(movie, results, snapshot_frame, Wkwargs, img_path=arguments.report_img_path)
+    with profiling.stage('report'):
+        output_report.produce_all_snapshots(movie, results, snapshot_frames, Wkwargs,
+                                            img_path=arguments.report_img_path,
+                                            n_cpu=arguments.ncpu,
+                                            fast=arguments.fast_report)
 
-    output_report.produce_distr_plots(results, Wkwargs, img_path=arguments.report_img_path)
+        output_report.produce_distr_plots(results, Wkwargs, img_path=arguments.report_img_path)
 
-    output_report.create_html(snapshot_frames, par_str, arguments.html_fname)
+        output_report.create_html(snapshot_frames, par_str, arguments.html_fname)
 
 except FileExistsError as e:
     logger.critical(f"Could not create html report directory: {repr(e)}")
 
 # --- save out result movies ---
 
-# None means output is filtered from galaxy settings
-if arguments.phase_out is not None:
-    # save phase movie
-    io.imsave(arguments.phase_out, results['phase'], plugin="tifffile")
-    logger.info(f'Written phase to {arguments.phase_out}')
-if arguments.period_out is not None:
-    # save period movie
-    io.imsave(arguments.period_out, results['period'], plugin="tifffile")
-    logger.info(f'Written period to {arguments.period_out}')
-if arguments.power_out is not None:
-    # save power movie
-    io.imsave(arguments.power_out, results['power'], plugin="tifffile")
-    logger.info(f'Written power to {arguments.power_out}')
-if arguments.amplitude_out is not None:
-    # save amplitude movie
-    io.imsave(arguments.amplitude_out, results['amplitude'], plugin="tifffile")
-    logger.info(f'Written amplitude to {arguments.amplitude_out}')
+with profiling.stage('write_tifs'):
+    # None means output is filtered from galaxy settings
+    if arguments.phase_out is not None:
+        # save phase movie
+        io.imsave(arguments.phase_out, results['phase'], plugin="tifffile")
+        logger.info(f'Written phase to {arguments.phase_out}')
+    if arguments.period_out is not None:
+        # save period movie
+        io.imsave(arguments.period_out, results['period'], plugin="tifffile")
+        logger.info(f'Written period to {arguments.period_out}')
+    if arguments.power_out is not None:
+        # save power movie
+        io.imsave(arguments.power_out, results['power'], plugin="tifffile")
+        logger.info(f'Written power to {arguments.power_out}')
+    if arguments.amplitude_out is not None:
+        # save amplitude movie
+        io.imsave(arguments.amplitude_out, results['amplitude'], plugin="tifffile")
+        logger.info(f'Written amplitude to {arguments.amplitude_out}')
+
+# all four movies in one chunked store
+if arguments.store_out is not None:
+    spyboat.save_results_to_store(results, arguments.store_out, Wkwargs)
+    logger.info(f'Written result store to {arguments.store_out}')
 
 # save out the probably pre-processed (scaled and blurred) input movie for
 # direct comparison to results and coordinate mapping etc.
 if arguments.preprocessed_out is not None:
     io.imsave(arguments.preprocessed_out, movie.astype(float32), plugin='tifffile')
     logger.info(f'Written preprocessed to {arguments.preprocessed_out}')
+
+# all outputs are written, the checkpoint isn't needed anymore
+if arguments.checkpoint_dir is not None:
+    clear_checkpoint(arguments.checkpoint_dir)
+
+if arguments.profile_json is not None:
+    profiling.log_summary()
+    profiling.write_json(arguments.profile_json)
@@ -1,16 +1,65 @@
 """ SpyBOAT - Spatial pyBOAT """
 
+import importlib
 
-__version__ = '0.1.2'
+__version__ = '0.2.0'
 
-# io
-from .io import open_tif, save_results_to_tifs, open_results
-# pre-processing
-from .util import down_sample, gaussian_blur
-# post-processing
-from .util import create_static_mask, create_dynamic_mask, apply_mask
+# The public API gets resolved lazily on first access, so that
+# `import spyboat` (and every spawned worker process) doesn't pay
+# for importing pyBOAT, scipy and scikit-image up front.
 
-# analysis
-from .processing import transform_stack, run_parallel
+# name -> submodule which provides it
+_api = {
+    # io
+    'open_tif' : 'io',
+    'save_results_to_tifs' : 'io',
+    'open_results' : 'io',
+    'save_results_to_store' : 'io',
+    'open_result_store' : 'io',
+    # pre-processing
+    'down_sample' : 'util',
+    'gaussian_blur' : 'util',
+    # post-processing
+    'create_static_mask' : 'util',
+    'create_dynamic_mask' : 'util',
+    'frame_thresholds' : 'util',
+    'PackedMask' : 'util',
+    'apply_mask' : 'util',
+    'distr_dynamics' : 'analysis',
+    'phase_coherence' : 'analysis',
+    # analysis
+    'transform_stack' : 'processing',
+    'run_parallel' : 'processing',
+    'run_out_of_core' : 'processing',
+    'check_precision' : 'processing',
+    'sweep_stack' : 'processing',
+    'run_sweep' : 'processing',
+    'WorkerPool' : 'processing',
+    'IncrementalAnalyzer' : 'incremental',
+    'ResultCache' : 'cache',
+    'run_batch' : 'batch',
+}
 
+_submodules = {'analysis', 'batch', 'cache', 'checkpoint', 'core', 'datasets', 'incremental', 'io', 'plotting',
+               'processing', 'profiling', 'util'}
 
+__all__ = list(_api)
+
+
+def __getattr__(name):
+
+    if name in _api:
+        module = importlib.import_module(f'.{_api[name]}', __name__)
+        attr = getattr(module, name)
+    elif name in _submodules:
+        attr = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # cache, __getattr__ only gets called for missing attributes
+    globals()[name] = attr
+    return attr
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_api) | _submodules)
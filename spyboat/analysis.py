@@ -0,0 +1,111 @@
+'''
+Per-frame statistics of the result movies, e.g. for the
+dynamics plots of `spyboat.plotting`. Every statistic gets computed
+for all frames at once and is returned as arrays, masked
+pixels are marked by a *mask_value*.
+'''
+
+import numpy as np
+
+from .profiling import profiled
+
+
+def _valid_pixels(movie, mask_value):
+
+    '''
+    Boolean (Frames, Y * X) array, True for the unmasked pixels
+    which also are not NaN, e.g. from constant time series
+    '''
+
+    movie = np.asarray(movie)
+    valid = movie != mask_value
+    if np.issubdtype(movie.dtype, np.floating):
+        valid &= ~np.isnan(movie)
+    return valid.reshape(movie.shape[0], -1)
+
+
+@profiled('distr_dynamics')
+def distr_dynamics(movie, mask_value = -1, percentiles = (25, 50, 75)):
+
+    '''
+    Percentiles of the unmasked pixel values of every frame of
+    the *movie*, with linear interpolation like `np.nanpercentile`,
+    NaNs are ignored.
+
+    All frames get sorted in a single pass, with the masked
+    pixels moved to the end. Frames without any unmasked pixel
+    give NaN.
+
+    Parameters
+    ----------
+
+    movie : ndarray with ndim = 3, (Frames, Y, X) ordering
+    mask_value : float, value of the masked pixels, e.g.
+                 the *fill_value* of `spyboat.run_parallel`
+    percentiles : sequence of floats in [0, 100]
+
+    Returns
+    -------
+
+    distr : float ndarray with shape (Frames, len(percentiles))
+    '''
+
+    movie = np.asarray(movie)
+    valid = _valid_pixels(movie, mask_value)
+    Nvalid = valid.sum(axis=1)
+
+    # NaNs get sorted to the end
+    values = np.where(valid, movie.reshape(movie.shape[0], -1), np.nan)
+    values.sort(axis=1)
+
+    last = np.maximum(Nvalid, 1)[:, None] - 1
+    positions = np.asarray(percentiles, dtype=float)[None, :] / 100 * last
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, last)
+    weights = positions - lower
+
+    low_values = np.take_along_axis(values, lower, axis=1).astype(float)
+    up_values = np.take_along_axis(values, upper, axis=1).astype(float)
+    distr = low_values + (up_values - low_values) * weights
+    distr[Nvalid == 0] = np.nan
+
+    return distr
+
+
+@profiled('phase_coherence')
+def phase_coherence(phase_movie, mask_value = -1):
+
+    '''
+    Kuramoto order parameter of the unmasked phases of every frame,
+    like `pyboat.core.complex_average` for each frame, in
+    one reduction over all frames. NaN phases are ignored.
+
+    Parameters
+    ----------
+
+    phase_movie : ndarray with ndim = 3, (Frames, Y, X) ordering,
+                  the phases in rad
+    mask_value : float, value of the masked pixels
+
+    Returns
+    -------
+
+    R : ndarray with shape (Frames,), the phase coherence
+        between 0 (incoherent) and 1 (synchronous)
+    Psi : ndarray with shape (Frames,), the mean phase in rad
+    '''
+
+    phase_movie = np.asarray(phase_movie)
+    valid = _valid_pixels(phase_movie, mask_value)
+    phases = phase_movie.reshape(phase_movie.shape[0], -1)
+    if not np.issubdtype(phases.dtype, np.floating):
+        phases = phases.astype(float)
+
+    # the trigonometry in the precision of the movie (32bit for
+    # SpyBOAT results), the sums in double precision
+    real = np.where(valid, np.cos(phases), 0).sum(axis=1, dtype=float)
+    imag = np.where(valid, np.sin(phases), 0).sum(axis=1, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z = (real + 1j * imag) / valid.sum(axis=1)
+
+    return np.abs(Z), np.angle(Z)
@@ -0,0 +1,267 @@
+'''
+Batch analysis of many movies, e.g. all wells of a plate, with the
+same parameters and a single pool of worker processes.
+
+The files get pipelined: while the workers transform one movie, the
+next one gets read and preprocessed, and the results of the previous
+one get written, each in a background thread. A summary table
+with one row per movie gets written at the end.
+'''
+
+import os
+import csv
+import glob
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .io import open_tif, save_results_to_tifs
+from .util import down_sample, gaussian_blur, create_static_mask, create_dynamic_mask
+from .analysis import distr_dynamics, phase_coherence
+from .processing import run_parallel, WorkerPool
+from .profiling import profiled
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SUMMARY_FIELDS = ('input', 'base_name', 'status', 'frames', 'ydim', 'xdim',
+                  'foreground_pixels', 'median_period', 'median_power',
+                  'mean_phase_coherence', 'transform_s')
+
+
+def read_manifest(fname):
+
+    '''
+    The input paths listed in the manifest *fname*, one per line.
+    Empty lines and lines starting with '#' get skipped, relative
+    paths are relative to the directory of the manifest.
+    '''
+
+    directory = os.path.dirname(os.path.abspath(fname))
+    with open(fname) as IN:
+        lines = [line.strip() for line in IN]
+
+    return [os.path.join(directory, line) for line in lines
+            if line and not line.startswith('#')]
+
+
+def expand_inputs(patterns):
+
+    '''
+    The sorted input paths matching the glob *patterns*, in order
+    of the patterns and without duplicates.
+    '''
+
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            logger.warning(f'No input matches {pattern}')
+        paths.extend(match for match in matches if match not in paths)
+
+    return paths
+
+
+def _base_names(input_paths):
+
+    ''' Unique output names, the file names without extension '''
+
+    names, seen = [], {}
+    for input_path in input_paths:
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}_{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+
+    return names
+
+
+def _load(input_path, rescale_factor, gauss_sigma, masking, mask_frame,
+          mask_thresh, dtype):
+
+    ''' Reads and preprocesses one movie, returns it with its mask '''
+
+    movie = open_tif(input_path)
+
+    if rescale_factor:
+        if not 0 < rescale_factor < 100:
+            raise ValueError('Scale factor must be between 0 and 100!')
+        movie = down_sample(movie, rescale_factor / 100, dtype=dtype)
+    if gauss_sigma:
+        movie = gaussian_blur(movie, gauss_sigma, dtype=dtype)
+
+    mask = None
+    if masking == 'static':
+        if mask_frame is None or not 0 <= mask_frame < movie.shape[0]:
+            raise ValueError(f'Mask frame {mask_frame} does not exist, input has {movie.shape[0]} frames')
+        mask = create_static_mask(movie, mask_frame, mask_thresh)
+    elif masking == 'dynamic':
+        mask = create_dynamic_mask(movie, mask_thresh, packed=True)
+
+    return movie, mask
+
+
+def _foreground_pixels(shape, mask):
+
+    if mask is None:
+        return shape[1] * shape[2]
+    if mask.ndim == 2:
+        return int(np.count_nonzero(~mask))
+    return int(np.count_nonzero(~mask.all(axis=0)))
+
+
+def _finish(results, base_name, out_dir, row, fill_value):
+
+    ''' Writes the results of one movie, and fills its summary *row* '''
+
+    save_results_to_tifs(results, base_name, out_dir)
+
+    with np.errstate(all='ignore'):
+        period = distr_dynamics(results['period'], fill_value, (50,))[:, 0]
+        power = distr_dynamics(results['power'], fill_value, (50,))[:, 0]
+        R = phase_coherence(results['phase'], fill_value)[0]
+
+    row['median_period'] = float(np.nanmedian(period))
+    row['median_power'] = float(np.nanmedian(power))
+    row['mean_phase_coherence'] = float(np.nanmean(R))
+    row['status'] = 'ok'
+
+
+@profiled('run_batch')
+def run_batch(input_paths, out_dir, n_cpu, Wkwargs, rescale_factor = None,
+              gauss_sigma = None, masking = None, mask_frame = None,
+              mask_thresh = 0, fill_value = -1, summary_fname = 'summary.csv',
+              chunk_size = None, cache = None, **Pkwargs):
+
+    '''
+    Analyzes all movies of *input_paths* with the same parameters,
+    with one pool of *n_cpu* worker processes for all. The four
+    result tifs of each movie get written to *out_dir* (see
+    `spyboat.io.save_results_to_tifs`), named after the input file.
+    A failing movie gets logged and marked in the summary, the
+    others still get analyzed.
+
+    Parameters
+    ----------
+
+    input_paths : sequence of str, the input tifs, see `read_manifest`
+                  and `expand_inputs`
+    out_dir : str, the output directory, gets created if needed
+    n_cpu : int, number of worker processes
+    Wkwargs : dictionary, the wavelet analysis parameters,
+              see `spyboat.processing.run_parallel`
+    rescale_factor : int, optional downsampling in %, see `down_sample`
+    gauss_sigma : float, optional Gaussian smoothing, see `gaussian_blur`
+    masking : str, 'static', 'dynamic' or None for no masking
+    mask_frame : int, frame of the static mask
+    mask_thresh : float or str, threshold of the masks, see
+                  `create_static_mask` and `create_dynamic_mask`
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    summary_fname : str, name of the summary table (csv) in *out_dir*
+    chunk_size : int, tile size, see `run_parallel`
+    cache : ResultCache, optional result cache, see `spyboat.cache`
+
+    Other Parameters
+    ----------------
+
+    **Pkwargs : further options of `run_parallel`, e.g. precision,
+                period_block or refine_ridge
+
+    Returns
+    -------
+
+    summary : list of dictionaries, one row per movie with the
+              fields of SUMMARY_FIELDS
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    base_names = _base_names(input_paths)
+    # single precision preprocessing only along with single precision transforms
+    dtype = np.float32 if Pkwargs.get('precision') == 'single' else np.float64
+    load_args = (rescale_factor, gauss_sigma, masking, mask_frame, mask_thresh,
+                 dtype)
+
+    summary = []
+    if not input_paths:
+        logger.warning('No input movies to analyze')
+
+    # one reading and one writing thread, so at most three
+    # movies are in memory at once
+    with WorkerPool(n_cpu) as pool, \
+         ThreadPoolExecutor(1) as reader, \
+         ThreadPoolExecutor(1) as writer:
+
+        loading = reader.submit(_load, input_paths[0], *load_args) if input_paths else None
+        writing = None
+
+        for ind, (input_path, base_name) in enumerate(zip(input_paths,
+                                                           base_names)):
+
+            row = {field : None for field in SUMMARY_FIELDS}
+            row.update(input = input_path, base_name = base_name)
+            summary.append(row)
+
+            current = loading
+            if ind + 1 < len(input_paths):
+                loading = reader.submit(_load, input_paths[ind + 1],
+                                        *load_args)
+
+            logger.info(f'Analyzing movie {ind + 1} of {len(input_paths)}: {input_path}')
+            try:
+                movie, mask = current.result()
+                row.update(frames = movie.shape[0], ydim = movie.shape[1],
+                           xdim = movie.shape[2],
+                           foreground_pixels = _foreground_pixels(movie.shape,
+                                                                  mask))
+                start = time.perf_counter()
+                results = run_parallel(movie, pool.n_cpu, pool = pool,
+                                       chunk_size = chunk_size, mask = mask,
+                                       fill_value = fill_value, cache = cache,
+                                       **Pkwargs, **Wkwargs)
+                row['transform_s'] = time.perf_counter() - start
+            except Exception as e:
+                logger.error(f'Analysis of {input_path} failed: {e!r}')
+                row['status'] = f'failed: {e!r}'
+                continue
+            finally:
+                movie = mask = None
+
+            # keep at most one movie waiting to be written
+            _wait(writing)
+            writing = (writer.submit(_finish, results, base_name, out_dir,
+                                     row, fill_value), row)
+            results = None
+
+        _wait(writing)
+
+    summary_path = os.path.join(out_dir, summary_fname)
+    with open(summary_path, 'w', newline='') as OUT:
+        table = csv.DictWriter(OUT, fieldnames=SUMMARY_FIELDS)
+        table.writeheader()
+        table.writerows(summary)
+
+    failed = sum(row['status'] != 'ok' for row in summary)
+    logger.info(f'Analyzed {len(summary) - failed} of {len(summary)} movie(s), '
+                f'summary written to {summary_path}')
+
+    return summary
+
+
+def _wait(writing):
+
+    ''' Waits for a *writing* (future, row) to finish, marks failures '''
+
+    if writing is None:
+        return
+
+    future, row = writing
+    try:
+        future.result()
+    except Exception as e:
+        logger.error(f"Writing the results of {row['input']} failed: {e!r}")
+        row['status'] = f'failed: {e!r}'
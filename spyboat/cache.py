@@ -0,0 +1,213 @@
+'''
+Content-addressed on-disk cache of analysis results, so that
+reruns of the same analysis, e.g. after a failed report, get served
+from disk instead of repeating the transforms.
+
+An entry is keyed by a hash of the movie bytes, the mask and all
+parameters which change the results, together with the versions of
+SpyBOAT, pyBOAT, numpy and scipy. Every entry is a single
+npz-file with the four result movies. When the cache grows beyond its
+size limit the least recently used entries get evicted.
+'''
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+from .profiling import profiled
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# default size limit of a cache directory
+MAX_CACHE_BYTES = 2**34
+
+
+def _versions():
+
+    from importlib.metadata import version, PackageNotFoundError
+    from . import __version__
+
+    versions = {'spyboat' : __version__}
+    for package in ('pyboat', 'numpy', 'scipy'):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def _hash_array(hasher, arr):
+
+    ''' Feeds *arr* frame by frame into *hasher*, avoiding a full copy '''
+
+    hasher.update(json.dumps([arr.shape, arr.dtype.str]).encode())
+    for frame in arr:
+        hasher.update(np.ascontiguousarray(frame).data)
+
+
+def save_npz(fname, arrays):
+
+    '''
+    Writes the dictionary of *arrays* as npz-file *fname* via a
+    temporary file, so readers never see partially written files.
+    '''
+
+    directory = os.path.dirname(fname) or '.'
+    fd, tmp_name = tempfile.mkstemp(prefix='.', suffix='.npz', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as OUT:
+            np.savez(OUT, **{name : np.asarray(arr)
+                             for name, arr in arrays.items()})
+        os.replace(tmp_name, fname)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def result_key(movie, mask = None, **params):
+
+    '''
+    The cache key of the results of *movie* analyzed with
+    *params* (e.g. the wavelet parameters), and optionally
+    masked with *mask* (boolean ndarray or `spyboat.util.PackedMask`).
+
+    Returns
+    -------
+
+    key : str, hex digest
+    '''
+
+    hasher = hashlib.blake2b(digest_size=20)
+    _hash_array(hasher, movie)
+
+    if mask is not None:
+        # boolean and packed masks give the same key
+        bits = getattr(mask, 'bits', None)
+        if bits is None:
+            bits = np.packbits(np.asarray(mask), axis=0)
+        hasher.update(json.dumps(list(mask.shape)).encode())
+        _hash_array(hasher, bits)
+
+    description = {'params' : params, 'versions' : _versions()}
+    hasher.update(json.dumps(description, sort_keys=True,
+                             default=str).encode())
+
+    return hasher.hexdigest()
+
+
+class ResultCache:
+
+    '''
+    On-disk cache of result movies in *directory*, see the module
+    docstring. Pass it as *cache* to `spyboat.run_parallel`.
+
+    Parameters
+    ----------
+
+    directory : str, the cache directory, gets created if needed
+    max_bytes : int, size limit of all entries together, the least
+                recently used entries get evicted beyond it
+    '''
+
+    def __init__(self, directory, max_bytes = MAX_CACHE_BYTES):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    @profiled('cache_load')
+    def load(self, key):
+
+        '''
+        The result movies of *key* as dictionary,
+        None if there is no such entry.
+        '''
+
+        fname = self._path(key)
+        try:
+            with np.load(fname) as entry:
+                results = {name : entry[name] for name in entry.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+        # the access time decides about the eviction
+        os.utime(fname)
+        logger.info(f'Loaded cached results {key}')
+        return results
+
+    @profiled('cache_store')
+    def store(self, key, results):
+
+        '''
+        Writes the *results* dictionary of movies as entry *key*,
+        then evicts old entries beyond the size limit.
+        '''
+
+        save_npz(self._path(key), results)
+
+        logger.info(f'Cached results {key}')
+        self.evict(keep = key)
+
+    def entries(self):
+
+        '''
+        The entries as list of (key, size in bytes, last access),
+        least recently used first.
+        '''
+
+        entries = []
+        for fname in os.listdir(self.directory):
+            key, ext = os.path.splitext(fname)
+            # skip the temporary files of unfinished entries
+            if ext != '.npz' or key.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, fname))
+            except FileNotFoundError:
+                # evicted concurrently
+                continue
+            entries.append((key, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep = None):
+
+        '''
+        Removes the least recently used entries until all entries
+        fit into *max_bytes*, never the entry *keep*.
+        '''
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info(f'Evicted cached results {key}')
+
+    def clear(self):
+
+        ''' Removes all entries '''
+
+        for key, _, _ in self.entries():
+            os.remove(self._path(key))
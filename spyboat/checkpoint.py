@@ -0,0 +1,98 @@
+'''
+Checkpoints of long running parallel analyses. The results of every
+finished tile get written into a checkpoint directory right away, so
+that a killed job can be resumed with only the remaining
+tiles, see `spyboat.run_parallel`.
+'''
+
+import os
+import json
+import logging
+import numpy as np
+
+from .cache import save_npz
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+META_FILE = 'checkpoint.json'
+
+
+def _tile_name(tile):
+
+    (ys, xs) = tile
+    return f'tile_{ys.start}-{ys.stop}_{xs.start}-{xs.stop}.npz'
+
+
+class Checkpoint:
+
+    '''
+    The finished tiles of an analysis in *directory*. The analysis
+    is identified by its *key* (see `spyboat.cache.result_key`),
+    so tiles of another analysis never get mixed in.
+
+    Parameters
+    ----------
+
+    directory : str, the checkpoint directory, gets created if needed
+    key : str, the key of the analysis
+    resume : bool, keep the finished tiles of an interrupted run
+             of the same analysis. Default is False, which
+             discards all earlier tiles.
+    '''
+
+    def __init__(self, directory, key, resume = False):
+
+        self.directory = directory
+        self.key = key
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as IN:
+                old_key = json.load(IN)['key']
+            if resume and old_key != key:
+                raise ValueError(f"Checkpoint in {directory} belongs to a different analysis, can't resume!")
+            if not resume:
+                clear_checkpoint(directory)
+                os.makedirs(directory, exist_ok=True)
+        elif resume:
+            logger.warning(f'No checkpoint found in {directory}, starting from scratch')
+
+        with open(meta_path, 'w') as OUT:
+            json.dump({'key' : key}, OUT)
+
+    def _path(self, tile):
+        return os.path.join(self.directory, _tile_name(tile))
+
+    def finished_tiles(self, tiles):
+
+        ''' The ones of *tiles* which are already done '''
+
+        return [tile for tile in tiles if os.path.exists(self._path(tile))]
+
+    def save_tile(self, tile, results):
+        save_npz(self._path(tile), results)
+
+    def load_tile(self, tile):
+
+        ''' The results of the finished *tile* as dictionary '''
+
+        with np.load(self._path(tile)) as entry:
+            return {key : entry[key] for key in entry.files}
+
+
+def clear_checkpoint(directory):
+
+    ''' Removes the checkpoint in *directory*, e.g. after success '''
+
+    if not os.path.isdir(directory):
+        return
+
+    for fname in os.listdir(directory):
+        if fname == META_FILE or (fname.startswith(('tile_', '.'))
+                                  and fname.endswith('.npz')):
+            os.remove(os.path.join(directory, fname))
+    # only if nothing else is in there
+    if not os.listdir(directory):
+        os.rmdir(directory)
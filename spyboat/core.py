@@ -0,0 +1,580 @@
+'''
+Batched counterparts of the pyBOAT core routines.
+
+Instead of transforming one pixel time series at a time,
+the functions here work on 2-dimensional blocks of signals
+with shape (Nt, Npix), so the time axis is always the 1st axis,
+consistent with the (Frames, Y, X) ordering of the movies.
+The wavelet transform itself is done via a single FFT along the time
+axis of the whole block, multiplied against a precomputed
+bank of (clipped) Morlet kernels. Likewise the preprocessing
+(sinc detrending and amplitude normalization) acts on all
+columns of a block at once.
+
+All routines work in the precision of the signals they get:
+float64 signals give complex128 spectra as pyBOAT does, float32 signals
+give complex64 spectra, which halves the memory traffic.
+'''
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from numpy import pi
+from scipy import fft as sp_fft
+from scipy.signal import fftconvolve, savgol_filter
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+from pyboat import core as pbcore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _next_pow2(n):
+
+    '''
+    Smallest power of 2 which is >= *n*, a fast FFT length
+    '''
+
+    return 1 << int(np.ceil(np.log2(n)))
+
+
+class MorletFilterBank:
+
+    '''
+    The Fourier transforms of the discretized Morlet wavelets
+    for all *periods*, such that a (zero-padded) multiplication with
+    the Fourier transform of a signal of length *Nt* yields exactly
+    the 'same'-mode convolution of `pyboat.core.CWT`, including its
+    clipping of the wavelet support.
+
+    The bank only depends on (Nt, dt, periods), so it gets built
+    once and is then shared by all pixels of a movie. Use
+    `get_filter_bank` to also reuse it across transforms.
+
+    Parameters
+    ----------
+
+    Nt : int, length of the signals to be transformed
+    dt : float, sampling interval
+    periods : ndarray with ndim = 1, the periods to compute the
+              transforms for
+
+    Attributes
+    ----------
+
+    kernels_ft : complex ndarray with shape (len(periods), Nfft),
+                 the Fourier transformed wavelets, Nfft is large
+                 enough to avoid any circular wrap-around
+    amplitude_factors : ndarray with shape (len(periods),), rescales
+                        the square root of the powers to amplitudes
+                        as in `pyboat.core.power_to_amplitude`
+    kernels_ft_single : complex64 version of *kernels_ft*, for
+                        single precision transforms
+    '''
+
+    def __init__(self, Nt, dt, periods):
+
+        self.Nt = int(Nt)
+        self.dt = float(dt)
+        self.periods = np.array(periods, dtype=float)
+        self.scales = pbcore.scales_from_periods(self.periods, 1 / self.dt,
+                                                 pbcore.omega0)
+        self.kernels_ft = self._mk_kernels_ft()
+        self.Nfft = self.kernels_ft.shape[1]
+
+        # signal_std independent part of pyboat.core.power_to_amplitude
+        self.amplitude_factors = 1 / np.sqrt(self.scales) * pi ** -0.25 \
+            * np.sqrt(2)
+
+        # shared between callers, so guard against accidental changes
+        for arr in (self.periods, self.scales, self.kernels_ft,
+                    self.amplitude_factors):
+            arr.flags.writeable = False
+
+        self._kernels_ft_single = None
+
+    @property
+    def key(self):
+        return _bank_key(self.Nt, self.dt, self.periods)
+
+    @property
+    def nbytes(self):
+        return self.kernels_ft.nbytes
+
+    @property
+    def kernels_ft_single(self):
+        # only built when a single precision transform asks for it
+        if self._kernels_ft_single is None:
+            self._kernels_ft_single = self.kernels_ft.astype(np.complex64)
+            self._kernels_ft_single.flags.writeable = False
+        return self._kernels_ft_single
+
+    def _mk_kernels_ft(self):
+
+        Nt = self.Nt
+        Morlet = pbcore.mk_Morlet(pbcore.omega0)
+
+        # mirror the support clipping of pyboat.core.CWT
+        supports = []
+        for scale in self.scales:
+            if pbcore.clip_support:
+                x_max = kernel_half_width(scale)
+            else:
+                x_max = Nt / 2
+
+            # max support is length of signal
+            if 2 * x_max > Nt:
+                vec = np.arange(-Nt / 2, Nt / 2)
+            else:
+                vec = np.arange(-x_max, x_max)
+            supports.append(vec)
+
+        Lmax = max(len(vec) for vec in supports)
+        Nfft = _next_pow2(Nt + Lmax - 1)
+
+        kernels = np.zeros((len(self.scales), Nfft), dtype=complex)
+        for ind, (scale, vec) in enumerate(zip(self.scales, supports)):
+            # 'same' mode takes the full convolution from this offset on,
+            # rolling the kernel lets the transform start at index 0
+            offset = (len(vec) - 1) // 2
+            kernels[ind, :len(vec)] = Morlet(vec, scale)
+            kernels[ind] = np.roll(kernels[ind], -offset)
+
+        return np.fft.fft(kernels, axis=1)
+
+
+def kernel_half_width(scale):
+
+    '''
+    Half width in samples of the clipped support of the Morlet
+    wavelet with *scale* (in sampling interval units), as in
+    `pyboat.core.CWT`. The transform at a time point depends on
+    the signal within this distance.
+    '''
+
+    y0 = pbcore.gauss_envelope(0, scale)
+    return int(pbcore.inverse_gauss(y0 / pbcore.peak_fraction, scale))
+
+
+# --- LRU cache of filter banks ---
+
+# maximal number of filter banks to keep around
+FILTER_BANK_CACHE_SIZE = 8
+
+_filter_banks = OrderedDict()
+
+
+def _bank_key(Nt, dt, periods):
+    return (int(Nt), float(dt), tuple(np.asarray(periods, dtype=float)))
+
+
+def get_filter_bank(Nt, dt, periods):
+
+    '''
+    Returns the `MorletFilterBank` for (Nt, dt, periods), it
+    only gets built if it is not already in the cache. The least
+    recently used bank gets dropped once more than
+    FILTER_BANK_CACHE_SIZE banks are cached.
+    '''
+
+    key = _bank_key(Nt, dt, periods)
+    bank = _filter_banks.get(key)
+    if bank is None:
+        bank = MorletFilterBank(Nt, dt, periods)
+    cache_filter_bank(bank)
+
+    return bank
+
+
+def cache_filter_bank(bank):
+
+    '''
+    Puts an already built *bank* into the cache, e.g. to
+    hand the parent's bank over to worker processes.
+    '''
+
+    _filter_banks[bank.key] = bank
+    _filter_banks.move_to_end(bank.key)
+    while len(_filter_banks) > FILTER_BANK_CACHE_SIZE:
+        _filter_banks.popitem(last=False)
+
+
+def clear_filter_banks():
+
+    ''' Empties the filter bank cache '''
+
+    _filter_banks.clear()
+
+
+# --- preprocessing ---
+
+def sinc_detrend(signals, T_c, dt, M = None):
+
+    '''
+    Batched version of `pyboat.core.sinc_smooth`, subtracts the
+    trend with periods longer than *T_c* from all columns
+    of *signals* with one FFT convolution along the time axis.
+
+    Parameters
+    ----------
+
+    signals : ndarray with ndim = 2, shape (Nt, Npix) - the time series
+              to detrend are the columns
+    T_c : float, the cut-off period of the sinc filter
+    dt : float, sampling interval
+    M : int, length of the filter window, is capped to Nt - 1 and
+        made even. Default is None, which takes the length of
+        `pyboat.core.sinc_smooth`, growing with Nt up to M_max.
+
+    Returns
+    -------
+
+    detrended : ndarray with shape (Nt, Npix)
+    '''
+
+    Nt = signals.shape[0]
+
+    # same filter length as pyboat.core.sinc_smooth by default
+    M = min(Nt - 1, pbcore.M_max if M is None else M)
+    M = M - 1 if M % 2 != 0 else M
+    w = pbcore.sinc_filter(M, dt / T_c)
+    L = len(w)
+
+    # mirror the signals at both ends, as pyboat.core.smooth does
+    padded = np.concatenate([signals[L - 1:0:-1], signals,
+                             signals[-1:-L:-1]], axis=0)
+    w = (w / w.sum()).astype(signals.dtype)
+    trend = fftconvolve(padded, w[:, None], mode='valid', axes=0)
+    trend = trend[(L - 1) // 2: trend.shape[0] - (L - 1) // 2]
+
+    return signals - trend
+
+
+def normalize_with_envelope(signals, window_size, dt):
+
+    '''
+    Batched version of `pyboat.core.normalize_with_envelope`,
+    divides all columns of *signals* by their amplitude envelope,
+    estimated by a centered sliding window (max - min) / 2 and
+    smoothed with a Savitzky-Golay filter of the same window size.
+
+    Parameters
+    ----------
+
+    signals : ndarray with ndim = 2, shape (Nt, Npix), the
+              (detrended) time series are the columns
+    window_size : float, the window size in time units
+    dt : float, sampling interval
+
+    Returns
+    -------
+
+    normalized : ndarray with shape (Nt, Npix)
+    '''
+
+    Nt = signals.shape[0]
+
+    if window_size > (Nt - 1) * dt:
+        window_size = (Nt - 1) * dt
+        logger.warning(f'Setting window_size to {window_size}!')
+
+    # window size in sampling interval units, has to be odd
+    wsize = int(window_size / dt)
+    if wsize % 2 != 1:
+        wsize = wsize + 1
+
+    centered = signals - signals.mean(axis=0)
+    # the windows get truncated at the boundaries, repeating
+    # the edge values doesn't change their max and min
+    amplitudes = (maximum_filter1d(centered, wsize, axis=0, mode='nearest') -
+                  minimum_filter1d(centered, wsize, axis=0, mode='nearest')) / 2
+    envelope = savgol_filter(amplitudes, window_length=wsize, polyorder=3,
+                             axis=0)
+
+    return signals / envelope
+
+
+# --- transforms ---
+
+def _fft_module(dtype):
+
+    '''
+    numpy's FFT for double precision (bit-identical to pyBOAT),
+    scipy's for single precision, as numpy < 2 always
+    computes in double precision.
+    '''
+
+    return sp_fft if dtype in (np.float32, np.complex64) else np.fft
+
+
+def fft_signals(signals, Nfft):
+
+    '''
+    The zero-padded Fourier transforms of the mean subtracted
+    columns of *signals*, as needed by `compute_spectra`. Can be
+    reused for all filter banks with the same Nfft.
+    '''
+
+    fft = _fft_module(signals.dtype)
+    return fft.fft(signals - signals.mean(axis=0), n=Nfft, axis=0)
+
+
+def compute_spectra(signals, bank, signals_ft = None):
+
+    '''
+    Batched version of `pyboat.core.compute_spectrum`, transforms
+    all signals of the (Nt, Npix) block *signals* at once.
+
+    Parameters
+    ----------
+
+    signals : ndarray with ndim = 2, shape (Nt, Npix) - the time series
+              to transform are the columns
+    bank : MorletFilterBank, built for the length of *signals*
+    signals_ft : complex ndarray with shape (bank.Nfft, Npix), the
+                 already computed `fft_signals`, e.g. when transforming
+                 the same signals with several banks. Default is None.
+
+    Returns
+    -------
+
+    modulus : ndarray with shape (nT, Nt, Npix), the Wavelet
+              power spectra normalized by signal variance, in the
+              precision of *signals*
+
+    transform : complex ndarray with shape (nT, Nt, Npix),
+                the Wavelet transforms
+    '''
+
+    Nt = signals.shape[0]
+    Nfft = bank.Nfft
+
+    sig2 = np.var(signals, axis=0)
+
+    if signals_ft is None:
+        signals_ft = fft_signals(signals, Nfft)
+    if signals.dtype == np.float32:
+        kernels_ft = bank.kernels_ft_single
+    else:
+        kernels_ft = bank.kernels_ft
+
+    fft = _fft_module(signals.dtype)
+    transform = fft.ifft(kernels_ft[:, :, None] * signals_ft[None, ...],
+                         axis=1)[:, :Nt, :]
+
+    # constant signals (e.g. background) give NaNs, just as pyBOAT does
+    with np.errstate(divide='ignore', invalid='ignore'):
+        modulus = np.abs(transform)**2 / sig2
+
+    return modulus, transform
+
+
+def max_ridge(modulus, transform, bank, sigma, interpolate = False):
+
+    '''
+    Evaluates the maximum ridge of every spectrum in the block
+    like `pyboat.core.get_maxRidge_ys`, and reads out the
+    instantaneous periods, powers, phases and amplitudes along it.
+
+    Parameters
+    ----------
+
+    modulus : ndarray with shape (nT, Nt, Npix)
+    transform : complex ndarray with shape (nT, Nt, Npix)
+    bank : MorletFilterBank, the transform was done with
+    sigma : ndarray with shape (Npix,), the standard deviations of the
+            transformed signals, needed for the amplitudes
+    interpolate : bool, refine the ridge between the periods of the bank
+                  with `interpolate_ridge`. Default is False.
+
+    Returns
+    -------
+
+    ridge_periods, powers, phases, amplitudes : ndarrays with shape (Nt, Npix)
+    '''
+
+    ridge_ys = np.argmax(modulus, axis=0)[None, ...]
+
+    powers = np.take_along_axis(modulus, ridge_ys, axis=0)[0]
+    phases = np.angle(np.take_along_axis(transform, ridge_ys, axis=0)[0])
+    # map to [0, 2pi]
+    phases = phases % (2 * pi)
+
+    if interpolate:
+        nT = modulus.shape[0]
+        lower = np.take_along_axis(modulus, np.maximum(ridge_ys - 1, 0),
+                                   axis=0)[0]
+        upper = np.take_along_axis(modulus, np.minimum(ridge_ys + 1, nT - 1),
+                                   axis=0)[0]
+        ridge_periods, powers, factors = interpolate_ridge(
+            ridge_ys[0], powers, lower, upper, bank)
+    else:
+        ridge_periods = bank.periods[ridge_ys[0]]
+        factors = bank.amplitude_factors[ridge_ys[0]]
+
+    amplitudes = np.sqrt(powers) * factors * sigma
+
+    return ridge_periods, powers, phases, amplitudes
+
+
+def interpolate_ridge(ridge_ys, powers, lower, upper, bank):
+
+    '''
+    Sub-grid refinement of the maximum ridge: fits a parabola through
+    the power at the ridge and at its two neighbouring periods, and
+    moves the ridge to its vertex. This way a coarse period grid
+    gives smooth period readouts, instead of scanning a dense grid.
+    At the borders of the period range the ridge stays on the grid.
+    The phases can be taken from the grid point, they barely change
+    across a period step.
+
+    Parameters
+    ----------
+
+    ridge_ys : int ndarray, the period indices of the ridge
+    powers : ndarray, the powers along the ridge
+    lower, upper : ndarrays, the powers at the next smaller and
+                   next larger period of the ridge
+    bank : MorletFilterBank, the transform was done with
+
+    Returns
+    -------
+
+    ridge_periods : ndarray, the interpolated periods
+    powers : ndarray, the interpolated powers at the vertex
+    amplitude_factors : ndarray, the interpolated amplitude factors
+                        of the bank for the new periods
+    '''
+
+    nT = len(bank.periods)
+    curvature = lower - 2 * powers + upper
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = 0.5 * (lower - upper) / curvature
+    # only proper maxima inside the period range get refined
+    inside = (ridge_ys > 0) & (ridge_ys < nT - 1) & (curvature < 0)
+    shift = np.where(inside, np.clip(shift, -0.5, 0.5), 0)
+
+    powers = powers - 0.25 * (lower - upper) * shift
+    positions = ridge_ys + shift
+    grid = np.arange(nT)
+    ridge_periods = np.interp(positions, grid, bank.periods)
+    factors = np.interp(positions, grid, bank.amplitude_factors)
+
+    return (ridge_periods.astype(powers.dtype, copy=False), powers,
+            factors.astype(powers.dtype, copy=False))
+
+
+def streaming_ridge(signals, bank, sigma, period_block, signals_ft = None,
+                    interpolate = False):
+
+    '''
+    Ridge-only version of `compute_spectra` followed by `max_ridge`,
+    which never holds the complete spectra. The periods get
+    transformed in blocks of *period_block*, and only the running
+    maximum power per time point, its period index and the
+    corresponding Wavelet coefficient are kept. The results are
+    identical to the ones of `max_ridge`, the first of several equal
+    maxima wins.
+
+    Parameters
+    ----------
+
+    signals : ndarray with ndim = 2, shape (Nt, Npix)
+    bank : MorletFilterBank, built for the length of *signals*
+    sigma : ndarray with shape (Npix,), the standard deviations of
+            the signals, needed for the amplitudes
+    period_block : int, number of periods to transform at once
+    signals_ft : complex ndarray, the already computed `fft_signals`,
+                 see `compute_spectra`
+    interpolate : bool, refine the ridge with `interpolate_ridge`, then
+                  also the powers of the two neighbouring periods
+                  are kept
+
+    Returns
+    -------
+
+    ridge_periods, powers, phases, amplitudes : ndarrays with shape (Nt, Npix)
+    '''
+
+    Nt = signals.shape[0]
+    sig2 = np.var(signals, axis=0)
+
+    if signals_ft is None:
+        signals_ft = fft_signals(signals, bank.Nfft)
+    if signals.dtype == np.float32:
+        kernels_ft = bank.kernels_ft_single
+    else:
+        kernels_ft = bank.kernels_ft
+
+    fft = _fft_module(signals.dtype)
+    nT = kernels_ft.shape[0]
+    period_block = max(1, int(period_block))
+
+    for start in range(0, nT, period_block):
+
+        transform = fft.ifft(kernels_ft[start:start + period_block, :, None] *
+                             signals_ft[None, ...], axis=1)[:, :Nt, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            modulus = np.abs(transform)**2 / sig2
+
+        block_ys = np.argmax(modulus, axis=0)[None, ...]
+        block_powers = np.take_along_axis(modulus, block_ys, axis=0)[0]
+        block_coeffs = np.take_along_axis(transform, block_ys, axis=0)[0]
+
+        if interpolate:
+            last = modulus.shape[0] - 1
+            block_lower = np.take_along_axis(
+                modulus, np.maximum(block_ys - 1, 0), axis=0)[0]
+            block_upper = np.take_along_axis(
+                modulus, np.minimum(block_ys + 1, last), axis=0)[0]
+            if start > 0:
+                # neighbours across the block borders
+                block_lower = np.where(block_ys[0] == 0, prev_last,
+                                       block_lower)
+                upper = np.where(ridge_ys == start - 1, modulus[0], upper)
+            prev_last = modulus[last]
+
+        if start == 0:
+            ridge_ys = block_ys[0]
+            powers = block_powers
+            coeffs = block_coeffs
+            if interpolate:
+                lower, upper = block_lower, block_upper
+            continue
+
+        # strictly larger, so that earlier periods win ties like with argmax
+        # NaN spectra (constant signals) stay at the first period
+        better = block_powers > powers
+        ridge_ys = np.where(better, block_ys[0] + start, ridge_ys)
+        powers = np.where(better, block_powers, powers)
+        coeffs = np.where(better, block_coeffs, coeffs)
+        if interpolate:
+            lower = np.where(better, block_lower, lower)
+            upper = np.where(better, block_upper, upper)
+
+    # map to [0, 2pi]
+    phases = np.angle(coeffs) % (2 * pi)
+    if interpolate:
+        ridge_periods, powers, factors = interpolate_ridge(
+            ridge_ys, powers, lower, upper, bank)
+    else:
+        ridge_periods = bank.periods[ridge_ys]
+        factors = bank.amplitude_factors[ridge_ys]
+
+    amplitudes = np.sqrt(powers) * factors * sigma
+
+    return ridge_periods, powers, phases, amplitudes
+
+
+def pixel_block_size(nT, Nfft, max_bytes, complex_bytes = 16):
+
+    '''
+    Number of pixels which can be transformed at once
+    while keeping the spectra (three complex (nT, Nfft, Npix)
+    temporaries at worst, with *complex_bytes* per element)
+    below *max_bytes*.
+    '''
+
+    return max(1, int(max_bytes // (3 * complex_bytes * nT * Nfft)))
@@ -1,18 +1,43 @@
 """ Provides the test data stacks of the repository """
 
 import os
-from skimage import io
+from functools import lru_cache
 
 # go to test_data directory
 data_dir = os.path.join(os.path.dirname(__file__),'test_data')
 
-# two rectanguar sinusoidal oscillatory domains with slightly
-# different periods
-two_sines = io.imread( os.path.join(data_dir, 'two_sines.tif'))
+# the stacks get read from disk on first access, name -> file name
+_files = {
+    # two rectanguar sinusoidal oscillatory domains with slightly
+    # different periods
+    'two_sines' : 'two_sines.tif',
+    # Example data graciously provided by Jihwan Myung,
+    # GIMBC Taipei Medical University
+    # SCN Bmal1 recording, subsampled in time and space
+    'SCN_Bmal1' : 'BmalLD-ssds.tif',
+}
 
-# Example data graciously provided by Jihwan Myung,
-# GIMBC Taipei Medical University
-# SCN Bmal1 recording, subsampled in time and space
-SCN_Bmal1 = io.imread( os.path.join(data_dir, 'BmalLD-ssds.tif'))
+__all__ = list(_files)
 
 
+@lru_cache(maxsize=None)
+def _load(name):
+
+    from skimage import io
+
+    movie = io.imread(os.path.join(data_dir, _files[name]))
+    # shared by all callers, so guard against accidental changes
+    movie.flags.writeable = False
+
+    return movie
+
+
+def __getattr__(name):
+
+    if name in _files:
+        return _load(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_files))
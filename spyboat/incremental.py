@@ -0,0 +1,347 @@
+'''
+Incremental analysis of growing movies, e.g. of an ongoing
+time-lapse acquisition where new frames arrive every so often.
+
+Instead of transforming the whole recording again for every new
+frame, only a trailing window of frames gets transformed. New frames
+can only change the results of the frames within reach of the
+end of the recording: the clipped support of the largest Morlet
+wavelet, plus the reaches of the detrending and amplitude normalization
+filters. All earlier frames are final. The cost per update therefore
+stays constant instead of growing with the length of the recording.
+
+To make the final frames independent of where the window ends, the
+preprocessing doesn't depend on the window: the sinc filter has a
+fixed length (see `sinc_length`), and the powers are normalized
+by the variance of all frames so far instead of the window's.
+'''
+
+import logging
+import numpy as np
+from pyboat import core as pbcore
+
+from . import core as spcore
+from .processing import transform_stack, run_parallel, RESULT_KEYS
+from .io import create_result_store, write_store_frames
+from .profiling import profiled
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# reach of the fixed length sinc filter, in cut-off periods to either side
+SINC_REACH = 4
+
+
+def sinc_length(Wkwargs):
+
+    '''
+    Fixed length (in frames) of the sinc filter for the detrending of
+    growing movies: SINC_REACH cut-off periods to either side, at most
+    the maximal length of `pyboat.core.sinc_smooth`. A transform of the
+    whole movie takes the longest filter which fits into the movie
+    instead, the detrended signals differ by about 1-2% of
+    their amplitude.
+    '''
+
+    M = 2 * int(np.ceil(SINC_REACH * Wkwargs['T_c'] / Wkwargs['dt']))
+    return min(M, pbcore.M_max)
+
+
+def coi_frames(Wkwargs):
+
+    '''
+    Number of frames at the end of a recording whose results can
+    still change when new frames get appended: the half width of the
+    clipped support of the largest Morlet wavelet (see
+    `spyboat.core.kernel_half_width`), plus the reaches of the sinc
+    filter (see `sinc_length`) and of the amplitude envelope, as
+    the transform acts on the preprocessed signals.
+    '''
+
+    dt = Wkwargs['dt']
+    # scale in sampling interval units
+    scale = pbcore.scales_from_periods(np.array([Wkwargs['Tmax']]), 1 / dt,
+                                       pbcore.omega0)[0]
+    reach = spcore.kernel_half_width(scale)
+
+    if Wkwargs.get('T_c') is not None:
+        reach += sinc_length(Wkwargs) // 2
+    if Wkwargs.get('win_size') is not None:
+        # sliding max/min plus Savitzky-Golay smoothing, both of
+        # the (odd) window size
+        reach += int(Wkwargs['win_size'] / dt) + 1
+
+    return int(reach)
+
+
+class IncrementalAnalyzer:
+
+    '''
+    Keeps the results of a growing movie up to date, see
+    the module docstring. Frames get added with `append`, the results
+    for all frames so far are in `results`.
+
+    The final frames don't depend on the window, but they can't
+    be identical to a transform of the complete movie:
+
+    - the sinc filter has a fixed length (see `sinc_length`), while
+      `transform_stack` takes the longest filter fitting the movie
+    - the powers of a frame are normalized by the variance of all
+      frames up to the update which finalized it. Trends which
+      are not removed let the variance grow with the recording.
+    - pyBOAT subtracts the mean of the complete signal, which shifts
+      the transforms of the first `halo` frames of the recording,
+      where the wavelets are cut off. These get finalized with the
+      mean of the frames so far.
+
+    On a synthetic movie of 1600 frames (periods 22-28 with a linear
+    trend, dt = 1, Tmax = 30) appended frame by frame, the maximal
+    deviations from `transform_stack` of the complete movie for
+    the frames at least `halo` frames from both ends are:
+
+    - without detrending: phases 5e-7 rad, periods and amplitudes
+      none, powers 240% (median 52%)
+    - with detrending (T_c = 40): phases 0.02 rad, periods 1 grid
+      step, amplitudes 1.2%, powers 3.2% (median 1%)
+
+    Within the first `halo` frames the phases deviate by up to 0.12 rad
+    with detrending, and by up to 2 rad without.
+
+    Parameters
+    ----------
+
+    Wkwargs : dictionary, the wavelet analysis parameters,
+              see `spyboat.processing.transform_stack`
+    mask : boolean ndarray with ndim = 2, static mask, holds True
+           for masked pixels. Default is None, no masking.
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    halo : int, number of frames at the end which still get
+           updated, defaults to `coi_frames`
+    window : int, number of trailing frames to transform per update,
+             at least 2 * halo + 1. Defaults to 4 * halo, then up to
+             2 * halo new frames get processed per transform.
+    store_path : str, optional result store (see
+                 `spyboat.io.create_result_store`) which gets
+                 updated with every appended frame
+    pool : WorkerPool, optional worker processes to transform
+           the window in parallel, see `spyboat.processing.run_parallel`
+
+    Attributes
+    ----------
+
+    n_frames : int, number of frames analyzed so far. The first
+               transform happens once `min_frames` (halo + 1)
+               frames have arrived.
+    '''
+
+    def __init__(self, Wkwargs, mask = None, fill_value = -1, halo = None,
+                 window = None, store_path = None, pool = None):
+
+        self.Wkwargs = dict(Wkwargs)
+        self.Wkwargs.setdefault('win_size', None)
+        self.mask = mask
+        self.fill_value = fill_value
+        self.store_path = store_path
+        self.pool = pool
+
+        self.sinc_length = None
+        if self.Wkwargs.get('T_c') is not None:
+            self.sinc_length = sinc_length(self.Wkwargs)
+
+        self.halo = coi_frames(self.Wkwargs) if halo is None else int(halo)
+        self.window = 4 * self.halo if window is None else int(window)
+        if self.window <= 2 * self.halo:
+            raise ValueError(f"Window of {self.window} frames must be larger than 2 * halo = {2 * self.halo}!")
+        # maximal number of new frames per transform
+        self.step = self.window - 2 * self.halo
+        # too short movies can't be transformed meaningfully
+        self.min_frames = self.halo + 1
+
+        # the trailing raw frames
+        self._buffer = None
+        # the flat indices of the pixels to transform
+        self._pixels = None
+        # number, sums and sums of squares of the preprocessed
+        # signals of the final frames, for the power normalization
+        self._n_final = 0
+        self._sums = None
+        # the result movies, with room to grow along the time axis
+        self._results = None
+        self.n_frames = 0
+
+        logger.info(f'Incremental analysis with a window of {self.window} frames, '
+                    f'the last {self.halo} frames get updated')
+
+    @property
+    def results(self):
+
+        ''' The four result movies of all frames analyzed so far '''
+
+        if self._results is None:
+            return None
+        return {key : movie[:self.n_frames] for key, movie in self._results.items()}
+
+    @profiled('incremental_append')
+    def append(self, frames):
+
+        '''
+        Adds the new *frames* (ndarray with shape (Y, X) for one
+        or (NFrames, Y, X) for several frames) to the analysis.
+
+        Returns
+        -------
+
+        first : int, the first frame whose results got updated,
+                results[first:] changed. None if there are not
+                enough frames yet.
+        '''
+
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[None, ...]
+        if self._buffer is not None and frames.shape[1:] != self._buffer.shape[1:]:
+            raise ValueError(f"Frames with shape {frames.shape[1:]} don't fit "
+                             f"to the movie with shape {self._buffer.shape[1:]}!")
+
+        first = None
+        for start in range(0, frames.shape[0], self.step):
+            updated = self._append_block(frames[start:start + self.step])
+            if first is None or (updated is not None and updated < first):
+                first = updated
+
+        return first
+
+    def _append_block(self, frames):
+
+        if self._buffer is None:
+            self._buffer = frames.copy()
+        else:
+            self._buffer = np.concatenate([self._buffer, frames])[-self.window:]
+
+        N_prev = self.n_frames
+        # the buffer has all frames until the first transform
+        N = N_prev + frames.shape[0] if N_prev else self._buffer.shape[0]
+        if N < self.min_frames:
+            return None
+
+        # the buffer holds the frames [N - len(buffer), N)
+        offset = N - self._buffer.shape[0]
+        first = 0 if offset == 0 else max(N_prev - self.halo, 0)
+
+        signals = self._preprocess()
+        res = self._transform(signals)
+
+        # powers normalized by the variance of all frames so far
+        # instead of the variance within the window
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factors = np.var(signals, axis=0) / self._variance(signals, offset)
+        powers = res['power'].reshape(res['power'].shape[0], -1)
+        powers[first - offset:, self._pixels] *= factors.astype(np.float32)
+        self._add_final(signals, N, offset)
+
+        self._grow(N)
+        for key in RESULT_KEYS:
+            self._results[key][first:N] = res[key][first - offset:]
+        self.n_frames = N
+
+        if self.store_path is not None:
+            if N_prev == 0:
+                create_result_store(self.store_path, (N, *frames.shape[1:]),
+                                    self.Wkwargs)
+            write_store_frames(self.store_path, first,
+                               {key : movie[first:N]
+                                for key, movie in self._results.items()})
+
+        return first
+
+    def _preprocess(self):
+
+        '''
+        The detrended and normalized signals of the pixels to
+        transform in the buffer, with shape (len(buffer), Npix)
+        '''
+
+        Nw = self._buffer.shape[0]
+        if self._pixels is None:
+            Npix = self._buffer[0].size
+            self._pixels = np.arange(Npix) if self.mask is None \
+                else np.flatnonzero(~self.mask)
+
+        signals = self._buffer.reshape(Nw, -1)[:, self._pixels].astype(float)
+        dt = self.Wkwargs['dt']
+        if self.Wkwargs['T_c'] is not None:
+            signals = spcore.sinc_detrend(signals, self.Wkwargs['T_c'], dt,
+                                          self.sinc_length)
+        if self.Wkwargs['win_size'] is not None:
+            signals = spcore.normalize_with_envelope(
+                signals, self.Wkwargs['win_size'], dt)
+
+        return signals
+
+    def _transform(self, signals):
+
+        ''' Transforms the preprocessed *signals* of the buffer '''
+
+        movie = np.zeros(self._buffer.shape)
+        movie.reshape(movie.shape[0], -1)[:, self._pixels] = signals
+        Wkwargs = dict(self.Wkwargs, T_c = None, win_size = None)
+
+        if self.pool is None:
+            return transform_stack(movie, mask = self.mask,
+                                   fill_value = self.fill_value, **Wkwargs)
+
+        return run_parallel(movie, self.pool.n_cpu, pool = self.pool,
+                            mask = self.mask, fill_value = self.fill_value,
+                            **Wkwargs)
+
+    def _variance(self, signals, offset):
+
+        '''
+        Variance of the preprocessed signals of all frames so far: the
+        final ones from the accumulated sums, the others from
+        the buffer holding the frames from *offset* on.
+        '''
+
+        if offset == 0:
+            return np.var(signals, axis=0)
+
+        rest = signals[self._n_final - offset:]
+        n = self._n_final + rest.shape[0]
+        mean = (self._sums[0] + rest.sum(axis=0)) / n
+        return (self._sums[1] + (rest**2).sum(axis=0)) / n - mean**2
+
+    def _add_final(self, signals, N, offset):
+
+        ''' Accumulates the sums of the frames which became final '''
+
+        n_final = max(N - self.halo, 0)
+        if offset == 0:
+            # the buffer still holds all frames
+            self._n_final = 0
+            self._sums = np.zeros((2, signals.shape[1]))
+
+        final = signals[self._n_final - offset:n_final - offset]
+        self._sums[0] += final.sum(axis=0)
+        self._sums[1] += (final**2).sum(axis=0)
+        self._n_final = n_final
+
+    def _grow(self, N):
+
+        ''' Makes room for *N* frames, doubling the capacity as needed '''
+
+        if self._results is None:
+            shape = (max(N, self.window), *self._buffer.shape[1:])
+            self._results = {key : np.zeros(shape, dtype=np.float32)
+                             for key in RESULT_KEYS}
+            return
+
+        capacity = self._results['phase'].shape[0]
+        if N <= capacity:
+            return
+
+        capacity = max(N, 2 * capacity)
+        for key, movie in self._results.items():
+            grown = np.zeros((capacity, *movie.shape[1:]), dtype=np.float32)
+            grown[:self.n_frames] = movie[:self.n_frames]
+            self._results[key] = grown
@@ -1,17 +1,19 @@
 ''' Provides I/O convenience routines ''' 
 
-import sys
 from os import path
 import logging
 import numpy as np
-from skimage import io
+import tifffile
+
+from .profiling import profiled
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- I/O ---
 
-def open_tif(fname):
+@profiled('open_tif')
+def open_tif(fname, memmap = False):
 
     '''
     The stack to analyze with SpyBOAT 
@@ -21,12 +23,20 @@ def open_tif(fname):
     Note that multi-channel (Fiji Hyperstacks) are not directly
     supported. Extract the channel of interest first!
 
+    Large stacks can be memory mapped instead of being read
+    into memory, opening is then near-instant and only the
+    frames actually touched get read from disc. This requires
+    an uncompressed and contiguous tif, as e.g. written by
+    Fiji or tifffile. For other tifs the whole stack gets read.
+
 
     Parameters
     ----------
 
     fname : string,
             Path to the tif-stack to be opened
+    memmap : bool, if True returns a read-only memory map
+             of the stack if possible. Default is False.
 
     Returns
     -------
@@ -40,15 +50,23 @@ def open_tif(fname):
 
     logger.info(f'Opening {fname}')
 
-    tif_stack = io.imread(fname, plugin = "tifffile")
+    tif_stack = None
+    if memmap:
+        try:
+            tif_stack = tifffile.memmap(fname, mode='r')
+            logger.info('Memory mapped the stack')
+        except ValueError as e:
+            logger.warning(f'Could not memory map {fname}: {e}, reading it completely..')
+
+    if tif_stack is None:
+        from skimage import io
+        tif_stack = io.imread(fname, plugin = "tifffile")
     
     # 4D-Hyperstack
     if len(tif_stack.shape) > 3:
 
-        logger.critical(f'Hyperstack detected with shape {tif_stack.shape}')
-        logger.critical(f'Hyperstacks are not supported, dimension of input stack must be 3!')
-
-        sys.exit(1)
+        raise ValueError(f'Hyperstack detected with shape {tif_stack.shape}, '
+                         'hyperstacks are not supported, dimension of input stack must be 3!')
 
     # 3D-Stack
     elif len(tif_stack.shape) == 3:
@@ -59,12 +77,99 @@ def open_tif(fname):
         return tif_stack
 
     else:
-        logger.critical(f'Input shape: {tif_stack.shape} [?]')
-        logger.critical('Movie has wrong number of dimensions, is it a single slice stack?!')
-        sys.exit(1)
+        raise ValueError(f'Input shape: {tif_stack.shape} [?], '
+                         'movie has wrong number of dimensions, is it a single slice stack?!')
+
+# --- Tile-wise access for out-of-core processing ---
+
+def tif_shape(fname):
+
+    '''
+    Returns the shape and dtype of the tif-stack *fname*,
+    without reading any image data.
+    '''
+
+    with tifffile.TiffFile(fname) as tif:
+        series = tif.series[0]
+        shape, dtype = series.shape, series.dtype
+
+    if len(shape) != 3:
+        raise ValueError(f'Input shape: {shape}, dimension of input stack must be 3!')
+
+    return shape, dtype
+
+def read_tif_tile(fname, tile):
+
+    '''
+    Reads the spatial *tile* of all frames of the tif-stack *fname*
+    without loading the whole stack. Uncompressed and contiguous tifs
+    get memory mapped, so only the touched pages get read.
+    Otherwise the frames get decoded one at a time, which
+    is considerably slower.
+
+    Parameters
+    ----------
+
+    fname : string,
+            Path to the tif-stack with (Frames, Y, X) ordering
+    tile : tuple of two slices, the (Y, X) region to read
+
+    Returns
+    -------
+
+    movie_tile : ndarray with ndim = 3, ordering is (Frames, Y, X)
+    '''
+
+    try:
+        movie = tifffile.memmap(fname, mode='r')
+        return np.array(movie[(slice(None), *tile)])
+    except ValueError:
+        pass
+
+    with tifffile.TiffFile(fname) as tif:
+        return np.stack([page.asarray()[tile] for page in tif.series[0].pages])
+
+def create_result_tifs(base_name, shape, directory = '.'):
+
+    '''
+    Creates the four (empty) result tifs of *shape* on disc,
+    named like in `save_results_to_tifs`. They can then be filled
+    tile by tile with `write_tif_tile`.
+
+    Returns
+    -------
+
+    out_paths : dictionary, the paths to the
+                phase, period, power and amplitude tifs
+    '''
+
+    out_paths = {}
+    for key in ['phase', 'period', 'power', 'amplitude']:
+        out_path = path.join(directory, f'{base_name}_{key}.tif')
+        # 32bit for Fiji
+        out = tifffile.memmap(out_path, shape=shape, dtype=np.float32)
+        del out
+        out_paths[key] = out_path
+        logger.info(f'Created {out_path}')
+
+    return out_paths
+
+def write_tif_tile(fname, tile, movie_tile):
+
+    '''
+    Writes the (Frames, Y, X) *movie_tile* into the spatial *tile*
+    of the (contiguous) tif-stack *fname*, as created by
+    `create_result_tifs`.
+    '''
+
+    movie = tifffile.memmap(fname, mode='r+')
+    movie[(slice(None), *tile)] = movie_tile
+    movie.flush()
+    del movie
 
 # ---- Output -----------------------------------------------
 
+@profiled('save_results_to_tifs')
 def save_results_to_tifs(results, base_name, directory = '.'):
 
     '''
@@ -88,6 +193,9 @@ def save_results_to_tifs(results, base_name, directory = '.'):
     directory : str, the target directory
                 defaults to cwd
     '''
+
+    from skimage import io
+
     # save phase movie
     out_path = path.join(directory, f'{base_name}_phase.tif')
     io.imsave(out_path, results['phase'], plugin="tifffile")
@@ -108,8 +216,146 @@ def save_results_to_tifs(results, base_name, directory = '.'):
     io.imsave(out_path, results['amplitude'], plugin="tifffile")
     logger.info(f'Written {out_path}')    
 
+# --- Chunked result store ---
+
+# default number of frames per chunk of a result store
+STORE_FRAME_CHUNK = 32
+# default spatial (Y, X) chunk size of a result store
+STORE_TILE_CHUNK = (128, 128)
+
+def _import_zarr():
+
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("Result stores need the optional 'zarr' package, "
+                          "install it with e.g. 'pip install zarr'")
+    return zarr
+
+def create_result_store(store_path, shape, Wkwargs = None, chunks = None):
+
+    '''
+    Creates a chunked and compressed Zarr directory store at
+    *store_path*, holding the (empty) phase, period, power and
+    amplitude movies of *shape* as 32bit arrays, and the
+    analysis parameters *Wkwargs* as attributes.
+
+    Chunks can be written in parallel by different processes,
+    as long as every process writes whole chunks (see `write_store_tile`).
+    Reading one frame or one pixel time series only
+    touches the chunks it needs.
+
+    Parameters
+    ----------
+
+    store_path : str, path of the store directory, e.g. 'results.zarr'
+    shape : tuple, the (Frames, Y, X) shape of the result movies
+    Wkwargs : dictionary, the wavelet analysis parameters to store
+    chunks : tuple of three ints, the (Frames, Y, X) chunk shape,
+             defaults to STORE_FRAME_CHUNK frames of STORE_TILE_CHUNK
+             pixels
+
+    Returns
+    -------
+
+    store : zarr.Group, holding the four result arrays
+    '''
+
+    zarr = _import_zarr()
+    from . import __version__
+
+    if chunks is None:
+        chunks = (STORE_FRAME_CHUNK, *STORE_TILE_CHUNK)
+    # the time axis is left alone, the store might grow along it
+    chunks = (int(chunks[0]), *(int(min(c, s)) for c, s in
+                                zip(chunks[1:], shape[1:])))
+
+    store = zarr.open_group(store_path, mode='w')
+    for key in ['phase', 'period', 'power', 'amplitude']:
+        # zarr 2 has no 'create_array'
+        create = getattr(store, 'create_array', None) or store.create_dataset
+        create(key, shape=tuple(shape), chunks=chunks, dtype=np.float32,
+               fill_value=0)
+
+    store.attrs.update({'spyboat_version' : __version__,
+                        'Wkwargs' : dict(Wkwargs or {})})
+    logger.info(f'Created result store {store_path} with chunks {chunks}')
+
+    return store
+
+def write_store_tile(store_path, tile, results):
+
+    '''
+    Writes the spatial *tile* of all four *results* movies
+    into the store at *store_path*. To be safe for parallel
+    writes, tiles must be aligned to the spatial chunks of the store.
+    '''
+
+    zarr = _import_zarr()
+    store = zarr.open_group(store_path, mode='r+')
+    for key in ['phase', 'period', 'power', 'amplitude']:
+        store[key][(slice(None), *tile)] = results[key]
+
+def write_store_frames(store_path, start, results):
+
+    '''
+    Writes the frames of all four *results* movies into the
+    store at *store_path*, beginning at frame *start*. The
+    store grows along the time axis if needed, so frames of
+    an ongoing recording can be appended.
+    '''
+
+    zarr = _import_zarr()
+    store = zarr.open_group(store_path, mode='r+')
+    for key in ['phase', 'period', 'power', 'amplitude']:
+        stop = start + results[key].shape[0]
+        if store[key].shape[0] < stop:
+            store[key].resize((stop, *store[key].shape[1:]))
+        store[key][start:stop] = results[key]
+
+@profiled('save_results_to_store')
+def save_results_to_store(results, store_path, Wkwargs = None,
+                          chunks = None):
+
+    '''
+    Saves all four transformation *results* together with the
+    analysis parameters *Wkwargs* into a single chunked and
+    compressed Zarr store, see `create_result_store`.
+    '''
+
+    store = create_result_store(store_path, results['phase'].shape,
+                                Wkwargs, chunks)
+    for key in ['phase', 'period', 'power', 'amplitude']:
+        store[key][...] = results[key]
+
+    logger.info(f'Written {store_path}')
+
+def open_result_store(store_path):
+
+    '''
+    Opens a result store as written by `save_results_to_store`
+    read-only. Nothing gets read until the movies get indexed, e.g.
+    results['phase'][frame] reads one frame and
+    results['period'][:, y, x] one pixel time series.
+
+    Returns
+    -------
+    results : dictionary, holds the four (lazy) output movies
+              (phase, period, power and amplitude)
+    Wkwargs : dictionary, the stored analysis parameters
+    '''
+
+    zarr = _import_zarr()
+    store = zarr.open_group(store_path, mode='r')
+
+    results = {key : store[key] for key in
+               ['phase', 'period', 'power', 'amplitude']}
+
+    return results, dict(store.attrs.get('Wkwargs', {}))
+
 # --- open a SpyBOAT output set of movies ---
 
+@profiled('open_results')
 def open_results(base_name, directory='.'):
 
     '''
@@ -131,6 +377,8 @@ def open_results(base_name, directory='.'):
 
     '''
 
+    from skimage import io
+
     results = {}
     for key in ['period','phase','power','amplitude']:
         in_path = path.join(directory, f'{base_name}_{key}.tif')
@@ -3,7 +3,7 @@ import matplotlib.pylab as ppl
 from numpy import pi
 import numpy as np
 
-from pyboat.core import complex_average
+from .analysis import distr_dynamics, phase_coherence
 
 # same for all snapshots
 margins = {'left' : 0.01, 'right':0.95, 'top':0.94, 'bottom':0.01}
@@ -87,21 +87,12 @@ def compute_distr_dynamics(movie, mask_value = -1):
     Calculates median and quartiles for every frame.
     Adheres to spyboats stack ordering: (Frames,Y,X)
     and skips over pixels with the *mask_value*.
+    See `spyboat.analysis.distr_dynamics`.
     '''
 
-    res = {'median' : [], 'q1' : [], 'q3' : []}
-    for img in movie:
-        
-        # flattened
-        values = img[img!=mask_value]
-        med = np.median(values)
-        q1 = np.percentile(values, 25)
-        q3 = np.percentile(values, 75)
-        res['median'].append(med)
-        res['q1'].append(q1)
-        res['q3'].append(q3)
+    q1, median, q3 = distr_dynamics(movie, mask_value, (25, 50, 75)).T
 
-    return res
+    return {'median' : median, 'q1' : q1, 'q3' : q3}
 
 def period_distr_dynamics(period_movie, Wkwargs, mask_value = -1):
 
@@ -160,13 +151,7 @@ def phase_coherence_dynamics(phase_movie, Wkwargs, mask_value = -1):
     Pass Wkwargs for time units.
     '''
 
-    Rs = []
-    for img in phase_movie:
-        
-        # flattened
-        values = img[img!=mask_value]
-        R, Psi = complex_average(values)
-        Rs.append(R)
+    Rs, Psis = phase_coherence(phase_movie, mask_value)
 
     fig, ax = ppl.subplots()
 
@@ -7,19 +7,62 @@ is the computational core of the spyboat module
 '''
 
 import sys
+import mmap
+from os import path
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 import logging
+from contextlib import nullcontext
+import tifffile
 
 # wavelet analysis
-from pyboat import core as pbcore
+from . import core as spcore
+from .util import apply_mask, PackedMask
+from .io import tif_shape, read_tif_tile, create_result_tifs, write_tif_tile
+from .io import (create_result_store, write_store_tile, open_result_store,
+                 STORE_FRAME_CHUNK)
+from . import profiling
+from .profiling import profiled
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# memory budget for the spectra of one block of pixels
+MAX_BLOCK_BYTES = 2**27
+
+# the output movies
+RESULT_KEYS = ('phase', 'period', 'power', 'amplitude')
+
+# memory budget for the tiles of out-of-core processing
+MAX_TILE_BYTES = 2**28
+
 # --- Spatial Wavelet Analysis ---
 
-def transform_stack(movie, dt, Tmin, Tmax, nT, T_c = None, win_size = None):
+def get_periods(Nt, dt, Tmin, Tmax, nT):
+
+    '''
+    The periods to scan for, the period range gets
+    clipped to what is admissible for a signal of length *Nt*.
+    '''
+
+    if Tmin < 2 * dt:
+        logger.warning('Warning, Nyquist limit is 2 times the sampling interval!')
+        logger.info('..setting Tmin to {:.2f}'.format( 2 * dt ))
+        Tmin = 2 * dt
+
+    if Tmax > dt * Nt: 
+        logger.warning('Warning: Very large periods chosen!')
+        Tmax = dt * (Nt-1)
+        logger.info(f'..setting Tmax to {Tmax:.2f}')
+
+    return np.linspace(Tmin, Tmax, nT)
+
+@profiled('transform_stack')
+def transform_stack(movie, dt, Tmin, Tmax, nT, T_c = None, win_size = None,
+                    out = None, mask = None, fill_value = -1,
+                    precision = 'double', period_block = None,
+                    refine_ridge = False):
 
     '''
     Analyzes a 3-dimensional array 
@@ -29,9 +72,15 @@ def transform_stack(movie, dt, Tmin, Tmax, nT, T_c = None, win_size = None):
     Returns four arrays with the same shape as the input
     array holding the results of the transform for each pixel.
 
+    The pixels are transformed in blocks with the batched
+    routines from `spyboat.core`, the size of a block is
+    bounded by MAX_BLOCK_BYTES for the intermediate spectra.
+
     For high spatial resolution input this might take a very
     long time as ydim \times xdim transformations have to be calculated!
     Parallel execution is recommended (see `run_parallel` below).
+    Supplying a *mask* restricts the transforms to the pixels of
+    the foreground.
 
     Parameters
     ----------
@@ -45,6 +94,34 @@ def transform_stack(movie, dt, Tmin, Tmax, nT, T_c = None, win_size = None):
                  sinc-detrending (not recommended!)
     win_size   : float, amplitude normalization sliding window size. 
                  Default is None which disables normalization.
+    out : dictionary, optional output movies with the same keys
+          and shape as the returned results to write into, e.g.
+          views into shared memory. Default is None, which
+          allocates new output movies.
+    mask : boolean ndarray, holds True for masked pixels, can be
+           both of ndim=2 for static, and ndim=3 for dynamic masks
+           (see `spyboat.util`). Only pixels which are not
+           masked in every frame get transformed. Default is None,
+           which transforms all pixels.
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    precision : str, 'double' (default) computes in float64/complex128
+                like pyBOAT, 'single' in float32/complex64, which
+                halves the memory traffic of the spectra. See
+                `check_precision` for the resulting deviations.
+    period_block : int, ridge-only mode: the periods get transformed in
+                   blocks of this many, keeping only the running
+                   maximum along the ridge instead of the complete
+                   spectra. The results are identical, but the working
+                   memory per pixel no longer grows with *nT*, so more
+                   pixels get transformed at once. Default is None,
+                   which transforms all periods at once.
+    refine_ridge : bool, adaptive period search: the ridge found on the
+                   period grid gets refined to its parabolic vertex
+                   between the neighbouring periods (see
+                   `spyboat.core.interpolate_ridge`). Gives smooth
+                   sub-grid period readouts already for a coarse
+                   grid, e.g. nT = 50 instead of 200. Default is False.
 
     Returns
     -------
@@ -57,94 +134,386 @@ def transform_stack(movie, dt, Tmin, Tmax, nT, T_c = None, win_size = None):
 
     '''
 
-    if Tmin < 2 * dt:
-        logger.warning('Warning, Nyquist limit is 2 times the sampling interval!')
-        logger.info('..setting Tmin to {:.2f}'.format( 2 * dt ))
-        Tmin = 2 * dt
-
-    if Tmax > dt * movie.shape[0]: 
-        logger.warning('Warning: Very large periods chosen!')
-        Tmax = dt * (movie.shape[0]-1)
-        logger.info(f'..setting Tmax to {Tmax:.2f}')
-    
     # the periods to scan for
-    periods = np.linspace(Tmin, Tmax, nT)
+    periods = get_periods(movie.shape[0], dt, Tmin, Tmax, nT)
 
     # create output arrays, needs 32bit for Fiji FloatProcessor :/
-    period_movie = np.zeros(movie.shape, dtype=np.float32)  
-    phase_movie = np.zeros(movie.shape, dtype=np.float32)  
-    power_movie = np.zeros(movie.shape, dtype=np.float32)  
-    amplitude_movie = np.zeros(movie.shape, dtype=np.float32)  
+    if out is None:
+        out = {key : np.zeros(movie.shape, dtype=np.float32)
+               for key in RESULT_KEYS}
 
-    ydim, xdim = movie.shape[1:] # F, Y, X ordering
-    
-    Npixels = ydim * xdim
+    Nt, ydim, xdim = movie.shape # F, Y, X ordering
+
+    # flat indices of the pixels to transform
+    pixel_inds = _pixel_indices(movie.shape, mask)
+    Npixels = len(pixel_inds)
     
     logger.info(f'Computing the transforms for {Npixels} pixels')
     sys.stdout.flush()
+    profiling.count_pixels(Npixels)
 
-    # loop over pixel coordinates
-    for x in range(xdim):
-
-        for y in range(ydim):
-
-            # show progress
-            if Npixels < 10:
-                logger.info(f"Processed {(ydim*x + y)/Npixels * 100 :.1f}%..")
-                sys.stdout.flush()
-
-            elif (ydim*x + y)%(int(Npixels/5)) == 0 and x != 0:
-                logger.info(f"Processed {(ydim*x + y)/Npixels * 100 :.1f}%..")
-            
-            input_vec = movie[:, y, x]  # the time_series at pixel (x,y)
-
-            signal = input_vec
-            
-            # detrending
-            if T_c is not None:
-                trend = pbcore.sinc_smooth(signal, T_c, dt)
-                signal = signal - trend
-                
-            # amplitude normalization?
-            if win_size is not None:
-                signal = pbcore.normalize_with_envelope(signal, win_size, dt)
-
-            sigma = np.std(signal)
-            Nt = len(signal)
-            
-            modulus, wlet = pbcore.compute_spectrum(signal, dt, periods)
-            ridge_ys = pbcore.get_maxRidge_ys(modulus)
-
-            ridge_periods = periods[ridge_ys]
-            powers = modulus[ridge_ys, np.arange(Nt)]
-            phases = np.angle(wlet[ridge_ys, np.arange(Nt)])
-            # map to [0, 2pi]
-            phases = phases % (2 * np.pi)
-            amplitudes = pbcore.power_to_amplitude(ridge_periods,
-                                                    powers, sigma, dt)
-            
-            phase_movie[:, y, x] = phases
-            period_movie[:, y, x] = ridge_periods
-            power_movie[:, y, x] = powers
-            amplitude_movie[:, y, x] = amplitudes
-
-    results = {'phase' : phase_movie, 'period' : period_movie,
-               'power' : power_movie, 'amplitude' : amplitude_movie}
-    
+    dtype = _compute_dtype(precision)
+
+    # the Morlet filter bank, the same for all pixels
+    bank = spcore.get_filter_bank(Nt, dt, periods)
+    block_size = _block_size(bank, dtype, period_block)
+
+    next_report = 0.2
+    # loop over blocks of pixels
+    for start in range(0, Npixels, block_size):
+
+        stop = min(start + block_size, Npixels)
+        # pixel coordinates of the block
+        ys, xs = np.unravel_index(pixel_inds[start:stop], (ydim, xdim))
+
+        # (Nt, Npix), every column is the time series of one pixel
+        signals = _preprocess(movie[:, ys, xs].astype(dtype), dt, T_c,
+                              win_size)
+
+        ridge_results = _ridge(signals, bank, period_block, refine_ridge)
+
+        for key, res in zip(('period', 'power', 'phase', 'amplitude'),
+                            ridge_results):
+            out[key][:, ys, xs] = res
+
+        # show progress
+        done = stop / Npixels
+        if done >= next_report and stop < Npixels:
+            logger.info(f"Processed {done * 100 :.1f}%..")
+            next_report = done + 0.2
+
+    if mask is not None:
+        for key in RESULT_KEYS:
+            apply_mask(out[key], mask, fill_value)
+
+    return out
+
+def _compute_dtype(precision):
+
+    ''' The real dtype of the computations for *precision* '''
+
+    if precision == 'double':
+        return np.dtype(np.float64)
+    elif precision == 'single':
+        return np.dtype(np.float32)
+    raise ValueError(f"Precision must be either 'double' or 'single', got {precision}")
+
+
+def _block_size(bank, dtype, period_block):
+
+    ''' Number of pixels per block, bounded by MAX_BLOCK_BYTES '''
+
+    nT = len(bank.periods)
+    if period_block is not None:
+        nT = min(nT, max(1, int(period_block)))
+
+    return spcore.pixel_block_size(nT, bank.Nfft, MAX_BLOCK_BYTES,
+                                   2 * dtype.itemsize)
+
+
+def _ridge(signals, bank, period_block, refine_ridge, signals_ft = None):
+
+    ''' The ridge readout of a preprocessed block of *signals* '''
+
+    sigma = np.std(signals, axis=0)
+    if period_block is not None:
+        return spcore.streaming_ridge(signals, bank, sigma, period_block,
+                                      signals_ft = signals_ft,
+                                      interpolate = refine_ridge)
+
+    modulus, wlet = spcore.compute_spectra(signals, bank,
+                                           signals_ft = signals_ft)
+    return spcore.max_ridge(modulus, wlet, bank, sigma,
+                            interpolate = refine_ridge)
+
+
+def _pixel_indices(shape, mask):
+
+    ''' Flat indices of the pixels which are not always masked '''
+
+    ydim, xdim = shape[1:]
+    if mask is None:
+        return np.arange(ydim * xdim)
+    elif mask.shape == tuple(shape):
+        return np.flatnonzero(~mask.all(axis=0))
+    elif mask.shape == tuple(shape[1:]):
+        return np.flatnonzero(~mask)
+    else:
+        raise ValueError(f"Shape of movie {shape} and mask {mask.shape} incompatible!")
+
+
+def _preprocess(signals, dt, T_c, win_size):
+
+    ''' Detrending and amplitude normalization of a whole block '''
+
+    if T_c is not None:
+        signals = spcore.sinc_detrend(signals, T_c, dt)
+    if win_size is not None:
+        signals = spcore.normalize_with_envelope(signals, win_size, dt)
+
+    return signals
+
+def check_precision(movie, n_pixels = 256, mask = None, seed = 42,
+                    **Wkwargs):
+
+    '''
+    Transforms a random sample of *n_pixels* (foreground) pixels
+    of the *movie* both in double and in single precision, and
+    reports the maximal deviations of the single precision results.
+
+    Parameters
+    ----------
+
+    movie : ndarray with ndim = 3, transform is done along 1st axis
+    n_pixels : int, size of the pixel sample
+    mask : boolean ndarray, static or dynamic mask, only
+           foreground pixels get sampled
+    seed : int, seed of the pixel sampling
+
+    Other Parameters
+    ----------------
+
+    **Wkwargs : the wavelet analysis parameters, see `transform_stack`
+
+    Returns
+    -------
+
+    deviations : dictionary, the maximal absolute deviation per output
+                 ('phase', 'period', 'power' and 'amplitude') and the
+                 maximal relative deviation of the powers and
+                 amplitudes ('power_rel' and 'amplitude_rel').
+                 Phase deviations are taken on the circle.
+    '''
+
+    Nt, ydim, xdim = movie.shape
+    pixel_inds = _pixel_indices(movie.shape, mask)
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(pixel_inds, size = min(n_pixels, len(pixel_inds)),
+                        replace = False)
+    ys, xs = np.unravel_index(np.sort(sample), (ydim, xdim))
+
+    # the sampled pixels as a (Nt, 1, n_pixels) movie
+    sub_movie = movie[:, ys, xs][:, None, :]
+
+    results = {precision : transform_stack(sub_movie, precision = precision,
+                                           **Wkwargs)
+               for precision in ('double', 'single')}
+
+    deviations = {}
+    for key in RESULT_KEYS:
+        double = results['double'][key].astype(float)
+        diff = np.abs(results['single'][key] - double)
+        if key == 'phase':
+            diff = np.minimum(diff, 2 * np.pi - diff)
+        deviations[key] = float(np.nanmax(diff))
+        if key in ('power', 'amplitude'):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                deviations[f'{key}_rel'] = float(np.nanmax(diff / np.abs(double)))
+
+    logger.info('Maximal deviations of single from double precision: ' +
+                ', '.join(f'{key} {dev:.2e}' for key, dev in deviations.items()))
+
+    return deviations
+
+# ------ Parameter sweeps ---------------------------------
+
+@profiled('sweep_stack')
+def sweep_stack(movie, param_sets, mask = None, fill_value = -1,
+                precision = 'double', period_block = None,
+                refine_ridge = False):
+
+    '''
+    Analyzes the *movie* like `transform_stack`, but for every
+    set of wavelet parameters in *param_sets* at once, e.g. to find
+    suitable periods, cut-off periods and window sizes for
+    a new dataset.
+
+    Every pixel gets read and preprocessed only once for all
+    parameter sets with the same (dt, T_c, win_size), and its Fourier
+    transform gets reused for all period grids. Only the
+    wavelet filtering and the ridge readout are done per parameter set.
+
+    Parameters
+    ----------
+
+    movie : ndarray with ndim = 3, transform is done along 1st axis
+    param_sets : sequence of dictionaries, each holding the wavelet
+                 analysis parameters (dt, Tmin, Tmax, nT, T_c and
+                 optionally win_size) as for `run_parallel`
+    mask : boolean ndarray, static or dynamic mask, see `transform_stack`
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    precision : str, 'double' or 'single', see `transform_stack`
+    period_block : int, ridge-only mode, see `transform_stack`
+    refine_ridge : bool, sub-grid ridge refinement, see `transform_stack`
+
+    Returns
+    -------
+
+    results : list of dictionaries, one per parameter set in order,
+              each with the four output movies as for `transform_stack`
+    '''
+
+    Nt, ydim, xdim = movie.shape
+    Wparams = [_wavelet_params(Wkwargs) for Wkwargs in param_sets]
+
+    pixel_inds = _pixel_indices(movie.shape, mask)
+    Npixels = len(pixel_inds)
+    logger.info(f'Computing the transforms for {Npixels} pixels and '
+                f'{len(Wparams)} parameter sets')
+    profiling.count_pixels(Npixels)
+
+    dtype = _compute_dtype(precision)
+    banks = [spcore.get_filter_bank(Nt, dt, get_periods(Nt, dt, Tmin, Tmax, nT))
+             for dt, Tmin, Tmax, nT, _, _ in Wparams]
+    block_size = min(_block_size(bank, dtype, period_block) for bank in banks)
+
+    # parameter sets sharing the same preprocessing
+    groups = {}
+    for ind, (dt, _, _, _, T_c, win_size) in enumerate(Wparams):
+        groups.setdefault((dt, T_c, win_size), []).append(ind)
+
+    outs = [{key : np.zeros(movie.shape, dtype=np.float32)
+             for key in RESULT_KEYS} for _ in Wparams]
+
+    for start in range(0, Npixels, block_size):
+
+        stop = min(start + block_size, Npixels)
+        ys, xs = np.unravel_index(pixel_inds[start:stop], (ydim, xdim))
+        raw = movie[:, ys, xs].astype(dtype)
+
+        for (dt, T_c, win_size), inds in groups.items():
+            signals = _preprocess(raw, dt, T_c, win_size)
+
+            # one Fourier transform per padded length
+            signals_fts = {}
+            for ind in inds:
+                bank = banks[ind]
+                if bank.Nfft not in signals_fts:
+                    signals_fts[bank.Nfft] = spcore.fft_signals(signals,
+                                                                bank.Nfft)
+                ridge_results = _ridge(signals, bank, period_block,
+                                       refine_ridge,
+                                       signals_ft = signals_fts[bank.Nfft])
+
+                for key, res in zip(('period', 'power', 'phase', 'amplitude'),
+                                    ridge_results):
+                    outs[ind][key][:, ys, xs] = res
+
+    if mask is not None:
+        for out in outs:
+            for key in RESULT_KEYS:
+                apply_mask(out[key], mask, fill_value)
+
+    return outs
+
+
+@profiled('run_sweep')
+def run_sweep(movie, n_cpu, param_sets, chunk_size = None, mask = None,
+              fill_value = -1, pool = None, precision = 'double',
+              period_block = None, refine_ridge = False):
+
+    '''
+    Parallel version of `sweep_stack`, the tiles of the movie get
+    swept by *n_cpu* worker processes, see `run_parallel`.
+
+    Parameters
+    ----------
+
+    movie : ndarray with ndim = 3, transform is done along 1st axis
+    n_cpu : int, number of requested processors
+    param_sets : sequence of dictionaries, the wavelet
+                 analysis parameter sets, see `sweep_stack`
+    chunk_size : int or tuple of two ints, the (Y, X) size of the tiles,
+                 see `run_parallel`
+    mask : boolean ndarray, static or dynamic mask
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    pool : WorkerPool, already running worker processes to use
+    precision : str, 'double' or 'single', see `transform_stack`
+    period_block : int, ridge-only mode, see `transform_stack`
+    refine_ridge : bool, sub-grid ridge refinement, see `transform_stack`
+
+    Returns
+    -------
+
+    results : list of dictionaries, one per parameter set in order,
+              each with the four output movies as for `run_parallel`
+    '''
+
+    if pool is not None:
+        n_cpu = pool.n_cpu
+
+    n_cpu = _check_n_cpu(n_cpu)
+    tiles = _foreground_tiles(movie.shape, mk_tiles(movie.shape[1:], n_cpu,
+                                                    chunk_size), mask)[0]
+
+    results = [{key : np.full(movie.shape, fill_value, dtype=np.float32)
+                for key in RESULT_KEYS} for _ in param_sets]
+
+    Npixels = sum(_tile_size(tile) for tile in tiles)
+    done, next_report = 0, 0.2
+
+    # the workers build and cache the filter banks themselves
+    with _open_pool(pool, n_cpu, None, chunk_size is not None) as workers:
+
+        logger.info(f"Sweeping {len(tiles)} tile(s) over {len(param_sets)} parameter sets..")
+        Tkwargs = {'fill_value' : fill_value, 'precision' : precision,
+                   'period_block' : period_block,
+                   'refine_ridge' : refine_ridge}
+        tasks = ((tile, movie[(slice(None), *tile)], param_sets,
+                  None if mask is None else mask[_mask_index(mask, tile)],
+                  Tkwargs) for tile in tiles)
+        for tile, res, stats in workers.imap_unordered(_star_sweep_tile, tasks):
+            for result, tile_result in zip(results, res):
+                for key in RESULT_KEYS:
+                    result[key][(slice(None), *tile)] = tile_result[key]
+            profiling.record_task(stats)
+            done, next_report = _log_progress(tile, done, Npixels,
+                                              next_report)
+
+    logger.info('Done with all transformations')
     return results
 
+
+def _sweep_tile(tile, movie_tile, param_sets, mask_tile, Tkwargs):
+
+    ''' Worker function of `run_sweep` '''
+
+    start = profiling.start_task()
+    results = sweep_stack(movie_tile, param_sets, mask = mask_tile, **Tkwargs)
+
+    return tile, results, profiling.finish_task(
+        start, _count_foreground(tile, mask_tile))
+
+
+def _star_sweep_tile(args):
+    return _sweep_tile(*args)
+
 # ------ Set up Multiprocessing  --------------------------
 
-def run_parallel(movie, n_cpu, **Wkwargs):
+@profiled('run_parallel')
+def run_parallel(movie, n_cpu, shared = False, chunk_size = None,
+                 mask = None, fill_value = -1, pool = None,
+                 precision = 'double', period_block = None,
+                 refine_ridge = False, cache = None, checkpoint_dir = None,
+                 resume = False, **Wkwargs):
 
     '''
     Sets up parallel processing of a 3-dimensional input movie.
     See `transform_stack` above for more details. Splits the input into
-    *n_cpu* slices which get transformed individually and then get
-    stitched back together after all transforms are done. Speedup
+    tiles which get transformed individually and are written back
+    into the output movies as soon as they are done. Speedup
     scales practically with *n_cpu*, e.g. 4 processes are 4 times
     faster than just using `transform_stack` directly.
 
+    By default the input gets split row-wise into *n_cpu* tiles.
+    With a *chunk_size* many small tiles get handed out dynamically
+    to the workers, so no worker sits idle while others still
+    have a big tile to go. With a *mask* only the foreground pixels
+    get transformed, and tiles which are completely masked
+    get skipped altogether.
+
     Returns four output movies with the same shape as the input.
 
     Parameters
@@ -153,6 +522,44 @@ def run_parallel(movie, n_cpu, **Wkwargs):
     movie : ndarray with ndim = 3, transform is done along 1st axis 
     n_cpu : int, number of requested processors. A check is done if more
                  are requested than available.
+    shared : bool, if True the input and the output movies live in
+                   shared memory blocks, the workers read their slices
+                   and write their results directly from/into these.
+                   Nothing gets pickled, which saves a lot of memory
+                   and time for large movies. A memory mapped input
+                   (see `open_tif`) doesn't get copied, but
+                   gets mapped by the workers directly.
+                   Default is False.
+    chunk_size : int or tuple of two ints, the (Y, X) size of the tiles
+                 for the dynamic scheduling. Default is None which
+                 splits the movie into *n_cpu* row-wise tiles.
+    mask : boolean ndarray, holds True for masked pixels, can be
+           both of ndim=2 for static, and ndim=3 for dynamic masks
+           as obtained from `create_static_mask` or
+           `create_dynamic_mask`. Default is None, no masking.
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    pool : WorkerPool, already running worker processes to use, then
+           *n_cpu* is ignored. Default is None, which starts
+           and stops a pool of *n_cpu* processes for this call only.
+    precision : str, 'double' (default) or 'single', the precision
+                of the computations, see `transform_stack`
+    period_block : int, ridge-only mode with periods transformed in
+                   blocks of this many, see `transform_stack`
+    refine_ridge : bool, sub-grid refinement of the ridge periods
+                   for coarse period grids, see `transform_stack`
+    cache : ResultCache, optional on-disk cache (see `spyboat.cache`),
+            results of an identical earlier analysis get loaded from
+            it, new results get stored. Default is None, no caching.
+    checkpoint_dir : str, optional directory in which the results of
+                     every finished tile get stored right away (see
+                     `spyboat.checkpoint`), e.g. for long jobs
+                     which might get killed. Default is None.
+    resume : bool, continue an interrupted run from its
+             *checkpoint_dir*, only the missing tiles get transformed.
+             Needs the same movie, mask and parameters, and the same
+             tiles (*chunk_size*, or *n_cpu* without a *chunk_size*).
+             The results are identical to an uninterrupted run.
 
     Other Parameters
     ----------------
@@ -168,7 +575,241 @@ def run_parallel(movie, n_cpu, **Wkwargs):
           'amplitude' : 32bit ndarray, holding the instantaneous amplitudes 
     '''
 
-    # starmap doesn't support **kwargs passing, we need to explicitly
+    if cache is not None or checkpoint_dir is not None:
+        key = _cache_key(movie, mask, fill_value, precision, refine_ridge,
+                         Wkwargs)
+    if cache is not None:
+        results = cache.load(key)
+        if results is not None:
+            return results
+
+    if pool is not None:
+        n_cpu = pool.n_cpu
+
+    n_cpu, bank, Wparams, tiles, skipped = _setup_parallel(
+        movie.shape, n_cpu, chunk_size, mask, Wkwargs)
+
+    # many small tiles, progress gets only logged by the parent
+    quiet = chunk_size is not None
+
+    # the keyword arguments of the workers' `transform_stack` calls
+    Tkwargs = {'fill_value' : fill_value, 'precision' : precision,
+               'period_block' : period_block,
+               'refine_ridge' : refine_ridge}
+
+    checkpoint, finished = None, []
+    if checkpoint_dir is not None:
+        from .checkpoint import Checkpoint
+
+        checkpoint = Checkpoint(checkpoint_dir, key, resume)
+        finished = checkpoint.finished_tiles(tiles)
+        if finished:
+            logger.info(f'Resuming, {len(finished)} of {len(tiles)} tile(s) are already done')
+        tiles = [tile for tile in tiles if tile not in finished]
+
+    with _open_pool(pool, n_cpu, bank, quiet) as workers:
+        if shared:
+            results = _run_shared(movie, workers, Wparams, tiles,
+                                  mask, Tkwargs, checkpoint)
+        else:
+            results = _run_pickled(movie, workers, Wparams, tiles,
+                                   mask, Tkwargs, checkpoint)
+
+    for tile in finished:
+        for name, res in checkpoint.load_tile(tile).items():
+            results[name][(slice(None), *tile)] = res
+
+    logger.info('Done with all transformations')        
+
+    if cache is not None:
+        cache.store(key, results)
+
+    return results
+
+
+def _cache_key(movie, mask, fill_value, precision, refine_ridge, Wkwargs):
+
+    '''
+    The `spyboat.cache` key of a `run_parallel` analysis, covering
+    all parameters which change the results. The tiling, the
+    period blocks and the shared memory don't.
+    '''
+
+    from .cache import result_key
+
+    dt, Tmin, Tmax, nT, T_c, win_size = _wavelet_params(Wkwargs)
+    # e.g. dt = 1 and dt = 1.0 give the same results
+    Wparams = {name : None if value is None else float(value)
+               for name, value in (('dt', dt), ('Tmin', Tmin), ('Tmax', Tmax),
+                                   ('T_c', T_c), ('win_size', win_size))}
+    Wparams['nT'] = int(nT)
+
+    return result_key(movie, mask, fill_value = fill_value,
+                      precision = precision, refine_ridge = refine_ridge,
+                      **Wparams)
+
+
+@profiled('run_out_of_core')
+def run_out_of_core(input_path, n_cpu, base_name, directory = '.',
+                    chunk_size = None, mask = None, fill_value = -1,
+                    out_format = 'tif', pool = None, precision = 'double',
+                    period_block = None, refine_ridge = False, **Wkwargs):
+
+    '''
+    Out-of-core version of `run_parallel` for tif-stacks larger
+    than the available memory. The workers read spatial tiles of all
+    frames directly from the input tif, transform them and write
+    the results tile by tile into the four result tifs:
+
+    *directory*/*base_name*_phase.tif
+    *directory*/*base_name*_period.tif
+    *directory*/*base_name*_power.tif
+    *directory*/*base_name*_amplitude.tif
+
+    Alternatively, with *out_format* 'zarr' the results and the
+    analysis parameters go into a single chunked result store
+    *directory*/*base_name*.zarr (see `spyboat.io.create_result_store`),
+    with spatial chunks aligned to the tiles.
+
+    Peak memory is then bounded by the tile size and not by
+    the size of the movie. Uncompressed and contiguous input tifs
+    are memory mapped, for other tifs every tile needs to decode
+    all frames, which is a lot slower.
+
+    Parameters
+    ----------
+
+    input_path : string, path to the tif-stack with (Frames, Y, X)
+                 ordering
+    n_cpu : int, number of requested processors
+    base_name : str, the common name of the result tifs
+    directory : str, the target directory, defaults to cwd
+    chunk_size : int or tuple of two ints, the (Y, X) size of the tiles.
+                 Default is None, which takes full-width row bands
+                 of at most MAX_TILE_BYTES working memory each.
+    mask : boolean ndarray, static or dynamic mask, see `run_parallel`
+    fill_value : float, all masked pixels of the output movies get
+                 set to this value
+    out_format : str, either 'tif' for four result tifs or 'zarr' for
+                 a single result store. Default is 'tif'.
+    pool : WorkerPool, already running worker processes to use,
+           see `run_parallel`
+    precision : str, 'double' (default) or 'single', see `transform_stack`
+    period_block : int, ridge-only mode, see `transform_stack`
+    refine_ridge : bool, sub-grid ridge refinement, see `transform_stack`
+
+    Other Parameters
+    ----------------
+
+    **Wkwargs : parameters for `transform_stack`,
+               the wavelet analysis parameters
+    Returns
+    -------
+    results : dictionary, with keys holding the (read-only) memory
+              mapped or zarr output movies 'phase', 'period', 'power'
+              and 'amplitude'
+    '''
+
+    if out_format not in ('tif', 'zarr'):
+        raise ValueError(f"Output format must be either 'tif' or 'zarr', got {out_format}")
+
+    shape, dtype = tif_shape(input_path)
+    logger.info(f'Out-of-core processing of {input_path} with shape {shape}')
+
+    if pool is not None:
+        n_cpu = pool.n_cpu
+
+    if chunk_size is None:
+        chunk_size = _band_size(shape, n_cpu)
+
+    n_cpu, bank, Wparams, tiles, skipped = _setup_parallel(
+        shape, n_cpu, chunk_size, mask, Wkwargs)
+
+    if out_format == 'zarr':
+        out_paths = path.join(directory, f'{base_name}.zarr')
+        # one chunk per tile in space, safe for parallel writes
+        cy, cx = _tile_grid(chunk_size)
+        create_result_store(out_paths, shape, Wkwargs,
+                            chunks=(STORE_FRAME_CHUNK, min(cy, shape[1]),
+                                    min(cx, shape[2])))
+    else:
+        out_paths = create_result_tifs(base_name, shape, directory)
+
+    for tile in skipped:
+        _write_results_tile(out_paths, tile, {key : fill_value
+                                              for key in RESULT_KEYS})
+
+    Npixels = sum(_tile_size(tile) for tile in tiles)
+    done, next_report = 0, 0.2
+
+    logger.info(f"Starting {n_cpu} process(es) for {len(tiles)} tile(s)..")
+    with _open_pool(pool, n_cpu, bank, True) as workers:
+
+        Tkwargs = {'fill_value' : fill_value, 'precision' : precision,
+                   'period_block' : period_block,
+                   'refine_ridge' : refine_ridge}
+        tasks = ((tile, input_path, out_paths, Wparams,
+                  None if mask is None else mask[_mask_index(mask, tile)],
+                  Tkwargs) for tile in tiles)
+        for tile, stats in workers.imap_unordered(_star_transform_file_tile,
+                                                  tasks):
+            profiling.record_task(stats)
+            done, next_report = _log_progress(tile, done, Npixels,
+                                              next_report)
+
+    logger.info('Done with all transformations')
+    if out_format == 'zarr':
+        return open_result_store(out_paths)[0]
+
+    return {key : tifffile.memmap(out_paths[key], mode='r')
+            for key in RESULT_KEYS}
+
+
+def _setup_parallel(shape, n_cpu, chunk_size, mask, Wkwargs):
+
+    '''
+    Checks the parameters for parallel processing of a movie
+    with *shape*, builds the filter bank and splits the movie into
+    the tiles to be processed and the fully masked ones to be skipped.
+    '''
+
+    Wparams = _wavelet_params(Wkwargs)
+    dt, Tmin, Tmax, nT, T_c, win_size = Wparams
+
+    if Wkwargs['T_c'] is None:
+        logger.info(f'No sinc-detrending requested..')
+    else:
+        logger.info(f"Sinc-detrending with cutoff {Wkwargs['T_c']}..")
+
+    if Wkwargs['win_size'] is None:
+        logger.info(f'No amplitude normalization requested..')
+    else:
+        logger.info(f"Amplitude normalization with {Wkwargs['win_size']}..")
+        
+
+    # --- set up multiprocessing ---
+
+    n_cpu = _check_n_cpu(n_cpu)
+
+    # build the filter bank only once, and hand it to all workers
+    periods = get_periods(shape[0], dt, Tmin, Tmax, nT)
+    bank = spcore.get_filter_bank(shape[0], dt, periods)
+
+    tiles, skipped = _foreground_tiles(shape, mk_tiles(shape[1:], n_cpu,
+                                                       chunk_size), mask)
+
+    return n_cpu, bank, Wparams, tiles, skipped
+
+
+def _wavelet_params(Wkwargs):
+
+    '''
+    The wavelet analysis parameters from *Wkwargs* as a tuple
+    (dt, Tmin, Tmax, nT, T_c, win_size), in the
+    positional order of `transform_stack`.
+    '''
+
+    # the workers don't support **kwargs passing, we need to explicitly
     # declare the parameters :/
     # defaults to None..
         
@@ -183,25 +824,37 @@ def run_parallel(movie, n_cpu, **Wkwargs):
         T_c = Wkwargs['T_c']
         win_size = Wkwargs['win_size']
     except KeyError as e:
-        logger.critical(f"Wavelet analysis parameter is missing: {repr(e)}, exiting..")
-        sys.exit(1)
+        raise ValueError(f"Wavelet analysis parameter is missing: {repr(e)}") from e
 
-    if Wkwargs['T_c'] is None:
-        logger.info(f'No sinc-detrending requested..')
-    else:
-        logger.info(f"Sinc-detrending with cutoff {Wkwargs['T_c']}..")
+    return dt, Tmin, Tmax, nT, T_c, win_size
 
-    if Wkwargs['win_size'] is None:
-        logger.info(f'No amplitude normalization requested..')
-    else:
-        logger.info(f"Amplitude normalization with {Wkwargs['win_size']}..")
-        
 
-    # --- set up multiprocessing ---
+def _foreground_tiles(shape, tiles, mask):
+
+    '''
+    Splits the *tiles* into the ones to be processed and
+    the ones which are fully masked and can be skipped.
+    '''
+
+    if mask is None:
+        return tiles, []
+
+    if mask.shape not in (tuple(shape), tuple(shape[1:])):
+        raise ValueError(f"Shape of movie {shape} and mask {mask.shape} incompatible!")
+    # pixels masked in all frames, cheap also for a `PackedMask`
+    background = mask.all(axis=0) if mask.ndim == 3 else np.asarray(mask)
+    masked = [background[tile].all() for tile in tiles]
+    skipped = [tile for tile, flag in zip(tiles, masked) if flag]
+    tiles = [tile for tile, flag in zip(tiles, masked) if not flag]
+    logger.info(f"Skipping {len(skipped)} of {len(tiles) + len(skipped)} tiles, they are fully masked")
+
+    return tiles, skipped
+
+
+def _check_n_cpu(n_cpu):
+
+    ''' Limits the requested *n_cpu* to the available processors '''
 
-    # initialize pool
-    pool = mp.Pool( n_cpu )
-    
     ncpu_avail = mp.cpu_count() # number of available processors
 
     logger.info(f"{ncpu_avail} CPU's available")
@@ -212,28 +865,438 @@ def run_parallel(movie, n_cpu, **Wkwargs):
 
         n_cpu = ncpu_avail
 
-    # split input movie row-wise (axis 1, axis 0 is time!)
-    movie_split = np.array_split(movie, n_cpu, axis = 1)    
-        
+    return n_cpu
+
+
+def mk_tiles(shape, n_cpu, chunk_size = None):
+
+    '''
+    Splits the spatial *shape* (ydim, xdim) of a movie into tiles,
+    either *n_cpu* row-wise tiles or tiles of *chunk_size*.
+
+    Returns
+    -------
+
+    tiles : list of tuples of slices, (Y, X) index expressions
+    '''
+
+    ydim, xdim = shape
+
+    if chunk_size is None:
+        # row-wise split (axis 1, axis 0 is time!)
+        bounds = np.linspace(0, ydim, n_cpu + 1).astype(int)
+        return [(slice(y0, y1), slice(0, xdim))
+                for y0, y1 in zip(bounds[:-1], bounds[1:]) if y1 > y0]
+
+    cy, cx = _tile_grid(chunk_size)
+
+    return [(slice(y0, min(y0 + cy, ydim)), slice(x0, min(x0 + cx, xdim)))
+            for y0 in range(0, ydim, cy) for x0 in range(0, xdim, cx)]
+
+
+def _tile_grid(chunk_size):
+
+    ''' The (Y, X) size of the tiles of *chunk_size*, see `mk_tiles` '''
+
+    cy, cx = (chunk_size, chunk_size) if np.isscalar(chunk_size) else chunk_size
+    if cy < 1 or cx < 1:
+        raise ValueError(f"Chunk size must be positive, got {chunk_size}!")
+
+    return int(cy), int(cx)
+
+
+def _band_size(shape, n_cpu):
+
+    '''
+    Full-width row bands with a working memory (float64 input
+    and four 32bit outputs) of at most MAX_TILE_BYTES,
+    and at least one band per processor.
+    '''
+
+    Nt, ydim, xdim = shape
+    pixel_bytes = Nt * (8 + 4 * 4)
+
+    cx = int(min(xdim, max(1, MAX_TILE_BYTES // pixel_bytes)))
+    cy = int(max(1, MAX_TILE_BYTES // (pixel_bytes * cx)))
+    cy = min(cy, int(np.ceil(ydim / n_cpu)))
+
+    return cy, cx
+
+
+def _mask_index(mask, tile):
+
+    ''' Index expression of *tile* into a static or dynamic *mask* '''
+
+    return tile if mask.ndim == 2 else (slice(None), *tile)
+
+
+def _tile_size(tile):
+    ys, xs = tile
+    return (ys.stop - ys.start) * (xs.stop - xs.start)
+
+
+def _count_foreground(tile, mask_tile):
+
+    ''' Number of pixels of *tile* which actually get transformed '''
+
+    if mask_tile is None:
+        return _tile_size(tile)
+    if mask_tile.ndim == 3:
+        mask_tile = mask_tile.all(axis=0)
+    return int(np.count_nonzero(~mask_tile))
+
+
+def _log_progress(tile, done, Npixels, next_report):
+
+    ''' Logs at every 20% of the processed pixels '''
+
+    done += _tile_size(tile)
+    if done / Npixels >= next_report and done < Npixels:
+        logger.info(f"Processed {done / Npixels * 100 :.1f}% of all tiles..")
+        next_report = done / Npixels + 0.2
+
+    return done, next_report
+
+
+def _init_worker(bank, quiet):
+
+    '''
+    Pool initializer, caches the filter *bank* in the worker,
+    with *quiet* only warnings get logged from the worker.
+    Without a *bank* the workers build and cache the
+    banks themselves as needed.
+    '''
+
+    if bank is not None:
+        spcore.cache_filter_bank(bank)
+    if quiet:
+        logger.setLevel(logging.WARNING)
+
+
+# ------ Worker pool --------------------------------------
+
+class WorkerPool:
+
+    '''
+    A pool of worker processes which stays alive across calls
+    of `run_parallel` and `run_out_of_core`, so repeated analyses
+    (e.g. sweeping over the wavelet parameters) don't pay for
+    starting the processes and importing pyBOAT every time. The
+    workers also keep their filter banks (see `spyboat.core`)
+    between calls.
+
+    Use it as a context manager, to have it shut down in the end:
+
+    with WorkerPool(4) as pool:
+        for Tmax in (30, 40, 50):
+            results = run_parallel(movie, 4, pool = pool, Tmax = Tmax, ...)
+
+    Parameters
+    ----------
+
+    n_cpu : int, number of worker processes, a check is done if more
+                 are requested than available.
+    quiet : bool, if True only warnings get logged from the
+                  workers. Default is True.
+    '''
+
+    def __init__(self, n_cpu, quiet = True):
+
+        self.n_cpu = _check_n_cpu(n_cpu)
+        logger.info(f"Starting pool of {self.n_cpu} worker process(es)..")
+        self._pool = _start_pool(self.n_cpu, None, quiet)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+
+        ''' Lets the workers finish and shuts them down '''
+
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+
+        ''' Stops the workers immediately '''
+
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _open_pool(pool, n_cpu, bank, quiet):
+
+    '''
+    Context for the processes of a single run: the already running
+    *pool* if given (which stays alive afterwards), otherwise a
+    new pool of *n_cpu* workers with the filter *bank* cached,
+    which gets shut down in the end.
+    '''
+
+    if pool is not None:
+        return nullcontext(pool._pool)
+
     logger.info(f"Starting {n_cpu} process(es)..")
-    
-    # start the processes, result is list
-    # of tuples (phase, period, power, amplitude)
-    res_movies = pool.starmap( transform_stack,
-                               [(movie, dt, Tmin, Tmax, nT, T_c, win_size)
-                                for movie in movie_split] )
-
-    results = {}
-    # re-join the splitted output movies
-    results['phase'] = np.concatenate([r['phase'] for r in res_movies],
-                                       axis=1)
-    results['period'] = np.concatenate([r['period'] for r in res_movies],
-                                    axis=1)
-    results['power'] = np.concatenate( [r['power'] for r in res_movies],
-                                       axis=1)
-    results['amplitude'] = np.concatenate([r['amplitude'] for r in res_movies],
-                                          axis=1)
+    return _start_pool(n_cpu, bank, quiet)
+
+
+def _start_pool(n_cpu, bank, quiet):
+
+    # forked workers have to inherit the resource tracker of the
+    # parent, otherwise they would start their own ones which don't
+    # know when the shared memory blocks (see `run_parallel`) get
+    # released by the parent
+    resource_tracker.ensure_running()
+
+    return mp.Pool(n_cpu, initializer=_init_worker, initargs=(bank, quiet))
+
+
+# ------ Pickled processing --------------------------------
+
+def _transform_tile(tile, movie_tile, Wparams, mask_tile, Tkwargs):
+
+    '''
+    Worker function, sends back the results with its *tile*
+    and the task statistics
+    '''
+
+    start = profiling.start_task()
+    results = transform_stack(movie_tile, *Wparams, mask = mask_tile,
+                              **Tkwargs)
+
+    return tile, results, profiling.finish_task(
+        start, _count_foreground(tile, mask_tile))
+
+
+def _run_pickled(movie, pool, Wparams, tiles, mask, Tkwargs,
+                 checkpoint = None):
+
+    '''
+    Runs the transforms by sending the tiles of the movie
+    to the workers of *pool*, see `run_parallel`. Finished tiles
+    get saved to the optional *checkpoint*.
+    '''
+
+    # 32bit for Fiji
+    results = {key : np.full(movie.shape, Tkwargs['fill_value'],
+                             dtype=np.float32)
+               for key in RESULT_KEYS}
+
+    Npixels = sum(_tile_size(tile) for tile in tiles)
+    done, next_report = 0, 0.2
+
+    logger.info(f"Processing {len(tiles)} tile(s)..")
+
+    tasks = ((tile, movie[(slice(None), *tile)], Wparams,
+              None if mask is None else mask[_mask_index(mask, tile)],
+              Tkwargs) for tile in tiles)
+    # write back the tiles in the order they finish
+    for tile, res, stats in pool.imap_unordered(_star_transform_tile, tasks):
+        for key in results:
+            results[key][(slice(None), *tile)] = res[key]
+        if checkpoint is not None:
+            checkpoint.save_tile(tile, res)
+        profiling.record_task(stats)
+        done, next_report = _log_progress(tile, done, Npixels, next_report)
+
+    return results
+
+
+def _star_transform_tile(args):
+    return _transform_tile(*args)
+
+
+# ------ Out-of-core processing ----------------------------
+
+def _transform_file_tile(tile, input_path, out_paths, Wparams, mask_tile,
+                         Tkwargs):
+
+    '''
+    Reads the *tile* from the input tif, transforms it
+    and writes the results into the result tifs.
+    '''
+
+    start = profiling.start_task()
+    movie_tile = read_tif_tile(input_path, tile)
+    results = transform_stack(movie_tile, *Wparams, mask = mask_tile,
+                              **Tkwargs)
+    _write_results_tile(out_paths, tile, results)
+
+    return tile, profiling.finish_task(start,
+                                       _count_foreground(tile, mask_tile))
+
+
+def _write_results_tile(out_paths, tile, results):
+
+    '''
+    Writes the *results* of *tile* either into the result
+    tifs or the result store, given by *out_paths*.
+    '''
+
+    if isinstance(out_paths, dict):
+        for key in RESULT_KEYS:
+            write_tif_tile(out_paths[key], tile, results[key])
+    else:
+        write_store_tile(out_paths, tile, results)
+
+
+def _star_transform_file_tile(args):
+    return _transform_file_tile(*args)
+
+
+# ------ Shared memory processing --------------------------
+
+def _attach_shared(specs):
+
+    '''
+    Maps the shared movies described by *specs* into the worker,
+    returns the attached blocks and the arrays keyed like *specs*.
+    '''
+
+    blocks, arrays = [], {}
+    for key, (name, shape, dtype, offset) in specs.items():
+
+        # a memory mapped file
+        if offset is not None:
+            arrays[key] = np.memmap(name, dtype=dtype, mode='r',
+                                    offset=offset, shape=shape)
+            continue
+
+        # pool workers share the resource tracker of the parent,
+        # which unlinks the blocks in the end
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    return blocks, arrays
+
+
+def _transform_shared_tile(tile, specs, Wparams, Tkwargs):
+
+    '''
+    Transforms the *tile* of the shared input movie and writes
+    the results straight into the shared output movies. The
+    blocks get attached only for the duration of the task, so
+    a long-lived worker doesn't keep them alive.
+    '''
+
+    start = profiling.start_task()
+    blocks, arrays = _attach_shared(specs)
+    try:
+        pixels = _transform_arrays_tile(tile, arrays, Wparams, Tkwargs)
+    finally:
+        # drop all views before the blocks can be closed
+        arrays.clear()
+    for shm in blocks:
+        shm.close()
+
+    return tile, profiling.finish_task(start, pixels)
+
+
+def _transform_arrays_tile(tile, arrays, Wparams, Tkwargs):
+
+    index = (slice(None), *tile)
+    out = {key : arrays[key][index] for key in RESULT_KEYS}
+
+    mask_tile = None
+    if 'mask' in arrays:
+        mask_tile = arrays['mask'][_mask_index(arrays['mask'], tile)]
+    elif 'mask_bits' in arrays:
+        # only the tile of a packed dynamic mask gets unpacked
+        mask = PackedMask(arrays['mask_bits'], arrays['input'].shape)
+        mask_tile = mask[index]
+
+    transform_stack(arrays['input'][index], *Wparams, out = out,
+                    mask = mask_tile, **Tkwargs)
+
+    return _count_foreground(tile, mask_tile)
+
+
+def _star_transform_shared_tile(args):
+    return _transform_shared_tile(*args)
+
+
+def _run_shared(movie, pool, Wparams, tiles, mask, Tkwargs,
+                checkpoint = None):
+
+    '''
+    Runs the transforms on shared memory with the workers
+    of *pool*, see `run_parallel`. Finished tiles get saved
+    to the optional *checkpoint*.
+
+    The input (and the mask) gets copied once into a shared block,
+    unless it is a memory mapped file which the workers can map
+    themselves. A `PackedMask` gets shared as packed bits, which
+    the workers unpack tile by tile. The four output movies get
+    allocated as shared blocks. After all workers are done, the
+    output movies get copied out one at a time and the respective
+    block gets released right away.
+    '''
+
+    blocks = {}
+    specs = {}
+    try:
+        inputs = {'input' : movie}
+        if isinstance(mask, PackedMask):
+            inputs['mask_bits'] = mask.bits
+        elif mask is not None:
+            inputs['mask'] = mask
+        for key, arr in inputs.items():
+
+            # only an unsliced memory map can be re-mapped by the workers
+            if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap):
+                specs[key] = (arr.filename, arr.shape, arr.dtype.str,
+                              arr.offset)
+                continue
+
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            blocks[key] = shm
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[key] = (shm.name, arr.shape, arr.dtype.str, None)
+
+        # 32bit for Fiji
+        out_nbytes = max(movie.size * np.dtype(np.float32).itemsize, 1)
+        for key in RESULT_KEYS:
+            shm = shared_memory.SharedMemory(create=True, size=out_nbytes)
+            blocks[key] = shm
+            specs[key] = (shm.name, movie.shape, np.dtype(np.float32).str,
+                          None)
+            np.ndarray(movie.shape, dtype=np.float32,
+                       buffer=shm.buf)[...] = Tkwargs['fill_value']
+
+        Npixels = sum(_tile_size(tile) for tile in tiles)
+        done, next_report = 0, 0.2
+
+        logger.info(f"Processing {len(tiles)} tile(s) on shared memory..")
+        tasks = ((tile, specs, Wparams, Tkwargs) for tile in tiles)
+        for tile, stats in pool.imap_unordered(_star_transform_shared_tile,
+                                               tasks):
+            if checkpoint is not None:
+                checkpoint.save_tile(tile, {
+                    key : np.ndarray(movie.shape, dtype=np.float32,
+                                     buffer=blocks[key].buf)[(slice(None), *tile)]
+                    for key in RESULT_KEYS})
+            profiling.record_task(stats)
+            done, next_report = _log_progress(tile, done, Npixels,
+                                              next_report)
+
+        results = {}
+        for key in RESULT_KEYS:
+            results[key] = np.ndarray(movie.shape, dtype=np.float32,
+                                      buffer=blocks[key].buf).copy()
+            _release(blocks.pop(key))
+
+    finally:
+        for shm in blocks.values():
+            _release(shm)
 
-    logger.info('Done with all transformations')        
     return results
 
+
+def _release(shm):
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,369 @@
+''' Lightweight timing and throughput instrumentation of the pipeline '''
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# profiling is off by default, then stages cost practically nothing
+_enabled = False
+
+# one record per finished stage, in order
+_stages = []
+
+# accumulated statistics of the pool workers, keyed by pid
+_workers = {}
+
+# the currently running stages of every thread, innermost last,
+# so concurrent stages of other threads don't get each other's pixels
+_local = threading.local()
+
+# the running stages of all threads, for the per stage peak RSS
+_running = []
+_peak_lock = threading.Lock()
+
+# peak RSS of the process in MB before the last reset of the peak
+_process_peak = 0.
+
+# whether the peak RSS can be reset (Linux), checked at the first stage
+_per_stage_peak = None
+
+
+def _active():
+
+    ''' The stack of running stages of the calling thread '''
+
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+def enable():
+
+    ''' Switches on recording of the stages '''
+
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+
+    ''' Drops all records '''
+
+    _stages.clear()
+    _workers.clear()
+
+
+def peak_rss_mb(who = 'self'):
+
+    '''
+    Peak resident set size in MB of this process (*who* = 'self'),
+    or of its largest terminated child process (*who* = 'children').
+    Returns None if the platform doesn't support this.
+    '''
+
+    if resource is None:
+        return None
+
+    who = resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN
+    rss = resource.getrusage(who).ru_maxrss
+
+    # bytes on macOS, kilobytes on Linux
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _hwm_mb():
+
+    ''' The peak RSS (high water mark) in MB since its last reset '''
+
+    try:
+        with open('/proc/self/status') as IN:
+            for line in IN:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak():
+
+    '''
+    Resets the peak RSS of the process to its current RSS,
+    returns False where this isn't supported.
+    '''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as OUT:
+            OUT.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _start_peak(info):
+
+    '''
+    Starts measuring the peak RSS of a new stage with *info*. The
+    peak so far goes to all running stages, then it gets reset.
+    '''
+
+    global _process_peak, _per_stage_peak
+
+    with _peak_lock:
+        if _per_stage_peak is None:
+            _per_stage_peak = _hwm_mb() is not None and _reset_peak()
+        if not _per_stage_peak:
+            return
+
+        peak = _hwm_mb()
+        for other in _running:
+            other['peak_rss_mb'] = max(other['peak_rss_mb'], peak)
+        _process_peak = max(_process_peak, peak)
+        _reset_peak()
+
+        info['peak_rss_mb'] = 0.
+        _running.append(info)
+
+
+def _finish_peak(info, record):
+
+    '''
+    Adds the peak RSS of the stage with *info* to its *record*,
+    or the peak of the process so far where the peak can't be reset.
+    '''
+
+    if not _per_stage_peak:
+        record['peak_rss_so_far_mb'] = peak_rss_mb()
+        return
+
+    with _peak_lock:
+        _running.remove(info)
+        record['peak_rss_mb'] = max(info['peak_rss_mb'], _hwm_mb())
+
+
+def _rate(pixels, wall):
+    return pixels / wall if wall > 0 else None
+
+
+@contextmanager
+def stage(name):
+
+    '''
+    Context manager recording the wall time, CPU time and
+    peak RSS of the enclosed code as stage *name*. Processed
+    pixels can be reported with `count_pixels`, from which the
+    throughput of the stage gets calculated.
+
+    The peak RSS of a stage ('peak_rss_mb') needs resetting the
+    peak of the process, which only Linux supports. Elsewhere the
+    records hold the peak of the process so far
+    ('peak_rss_so_far_mb') instead. The CPU time is the one of the
+    whole process, so it includes concurrent stages of other threads.
+    '''
+
+    if not _enabled:
+        yield
+        return
+
+    info = {}
+    active = _active()
+    active.append(info)
+    _start_peak(info)
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        active.pop()
+        wall = time.perf_counter() - wall0
+        record = {'stage' : name,
+                  'wall_s' : wall,
+                  'cpu_s' : time.process_time() - cpu0}
+        _finish_peak(info, record)
+        if 'pixels' in info:
+            record['pixels'] = int(info['pixels'])
+            record['pixels_per_s'] = _rate(info['pixels'], wall)
+        _stages.append(record)
+
+
+def count_pixels(pixels):
+
+    '''
+    Adds *pixels* to the processed pixels of the innermost
+    stage of the calling thread
+    '''
+
+    if not _enabled:
+        return
+
+    active = _active()
+    if active:
+        active[-1]['pixels'] = active[-1].get('pixels', 0) + pixels
+
+
+def profiled(name):
+
+    '''
+    Decorator, records every call of the decorated
+    function as stage *name*.
+    '''
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# --- worker statistics ---
+
+def start_task():
+
+    ''' Marks the start of a task in a worker process '''
+
+    return time.perf_counter(), time.process_time()
+
+
+def finish_task(start, pixels):
+
+    '''
+    Statistics of a task of a worker process, started
+    with `start_task`, which processed *pixels* pixels.
+    Gets send back to the parent and collected with `record_task`.
+    '''
+
+    wall0, cpu0 = start
+    return {'pid' : os.getpid(),
+            'wall_s' : time.perf_counter() - wall0,
+            'cpu_s' : time.process_time() - cpu0,
+            'pixels' : int(pixels),
+            'peak_rss_mb' : peak_rss_mb()}
+
+
+def record_task(task):
+
+    '''
+    Accumulates the *task* statistics per worker, its pixels
+    also count for the innermost stage of the parent.
+    '''
+
+    if not _enabled:
+        return
+
+    count_pixels(task['pixels'])
+
+    worker = _workers.setdefault(task['pid'], {'tasks' : 0, 'wall_s' : 0.,
+                                               'cpu_s' : 0., 'pixels' : 0,
+                                               'peak_rss_mb' : None})
+    worker['tasks'] += 1
+    worker['wall_s'] += task['wall_s']
+    worker['cpu_s'] += task['cpu_s']
+    worker['pixels'] += task['pixels']
+    if task['peak_rss_mb'] is not None:
+        worker['peak_rss_mb'] = max(worker['peak_rss_mb'] or 0,
+                                    task['peak_rss_mb'])
+
+
+# --- output ---
+
+def summary():
+
+    '''
+    Machine readable summary of all recorded stages and workers.
+
+    Returns
+    -------
+
+    summary : dictionary with
+         'stages' : list, one record per stage in order of completion,
+                    with the peak RSS of the stage, see `stage`
+         'totals' : dictionary, the records summed up per stage name
+         'workers' : list, accumulated statistics per worker process
+         'peak_rss_mb' : float, peak RSS of the main process
+         'peak_rss_children_mb' : float, peak RSS of the largest
+                                  terminated worker
+    '''
+
+    from . import __version__
+
+    totals = {}
+    for record in _stages:
+        total = totals.setdefault(record['stage'], {'calls' : 0, 'wall_s' : 0.,
+                                                    'cpu_s' : 0.})
+        total['calls'] += 1
+        total['wall_s'] += record['wall_s']
+        total['cpu_s'] += record['cpu_s']
+        if 'pixels' in record:
+            total['pixels'] = total.get('pixels', 0) + record['pixels']
+            total['pixels_per_s'] = _rate(total['pixels'], total['wall_s'])
+
+    workers = []
+    for pid, worker in _workers.items():
+        workers.append({'pid' : pid, **worker,
+                        'pixels_per_s' : _rate(worker['pixels'],
+                                               worker['wall_s'])})
+
+    return {'spyboat_version' : __version__,
+            'stages' : list(_stages),
+            'totals' : totals,
+            'workers' : workers,
+            'peak_rss_mb' : _overall_peak(),
+            'peak_rss_children_mb' : peak_rss_mb('children')}
+
+
+def _overall_peak():
+
+    ''' Peak RSS of the main process, also before resets by the stages '''
+
+    peak = peak_rss_mb()
+    if _per_stage_peak:
+        peak = max(_process_peak, _hwm_mb())
+    return peak
+
+
+def write_json(fname):
+
+    ''' Writes the `summary` as json to *fname* '''
+
+    with open(fname, 'w') as OUT:
+        json.dump(summary(), OUT, indent=2)
+
+    logger.info(f'Written profile to {fname}')
+
+
+def log_summary():
+
+    ''' Logs a short overview of the stage totals '''
+
+    for name, total in summary()['totals'].items():
+        rate = total.get('pixels_per_s')
+        rate = f', {rate:.1f} pixels/s' if rate else ''
+        logger.info(f"{name}: {total['calls']} call(s), {total['wall_s']:.2f}s wall, "
+                    f"{total['cpu_s']:.2f}s CPU{rate}")
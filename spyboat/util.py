@@ -1,24 +1,72 @@
 ''' Provies I/O and pre- and postprocessing routines ''' 
 
+import os
 import sys
 from os import path
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from skimage import io
-from skimage.transform import rescale
-from skimage.filters import gaussian, threshold_otsu
+
+from .profiling import profiled
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- pre-processing ---
 
-def down_sample(movie, scale_factor):
+# frames per task of the preprocessing threads
+FRAMES_PER_TASK = 16
+
+
+def _map_frames(func, movie, out, n_threads):
+
+    '''
+    Applies *func* to consecutive blocks of frames of *movie*,
+    writing into the corresponding frames of *out*. The blocks
+    get processed by *n_threads* threads, the underlying scipy
+    filters release the GIL.
+    '''
+
+    blocks = [slice(start, min(start + FRAMES_PER_TASK, movie.shape[0]))
+              for start in range(0, movie.shape[0], FRAMES_PER_TASK)]
+
+    def work(block):
+        out[block] = func(movie[block])
+
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    n_threads = max(1, min(n_threads, len(blocks)))
+
+    if n_threads == 1:
+        for block in blocks:
+            work(block)
+    else:
+        with ThreadPoolExecutor(n_threads) as executor:
+            # consume the iterator to re-raise exceptions
+            list(executor.map(work, blocks))
+
+    return out
+
+
+def _check_out(out, shape, dtype):
+
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != tuple(shape):
+        raise ValueError(f"Shape of output {out.shape} must be {tuple(shape)}!")
+    return out
+
+
+@profiled('down_sample')
+def down_sample(movie, scale_factor, method = 'interpolate',
+                dtype = np.float64, out = None, n_threads = None):
 
     '''
     Spatially downsamples a 3-dimensional input movie (NFrames, y, x). 
     It basically wraps around skimage.transform.rescale 
-    to properly work on image stacks (movies). 
+    to properly work on image stacks (movies), using
+    the factor 1 along the time axis. The frames get processed
+    in blocks by multiple threads.
 
     Parameters
     ----------
@@ -28,6 +76,18 @@ def down_sample(movie, scale_factor):
     scale_factor : float, must be 0 < scale_factor <= 1 as 
                           only downsampling is supported/meaningful 
                           here. Goes into `skimage.transform.rescale`
+    method : str, 'interpolate' for (anti-aliased) interpolation as
+                  done by `skimage.transform.rescale`, or 'block'
+                  for averaging non-overlapping blocks of
+                  1/scale_factor x 1/scale_factor pixels, needs
+                  1/scale_factor to be an integer. Trailing pixels
+                  not filling a whole block get dropped.
+    dtype : numpy dtype of the output movie, defaults to float64.
+            float32 halves the memory, but slightly changes
+            the transform results.
+    out : ndarray, optional output array of the downsampled shape
+    n_threads : int, number of threads to use, None means one
+                per CPU
 
     Returns
     -------
@@ -39,24 +99,47 @@ def down_sample(movie, scale_factor):
 
     if scale_factor > 1:
         raise ValueError ('Upscaling is not supported!')
-    
-    # rescale only 1st frame to inquire output shape
-    frame1 = rescale(movie[0,...], scale = scale_factor,
-                     preserve_range=True)
-    movie_ds = np.zeros( (movie.shape[0], *frame1.shape) )
-    
-    for frame in range(movie.shape[0]):
-        movie_ds[frame,...] = rescale(movie[frame,...],
-                                      scale = scale_factor,
-                                      preserve_range=True)
 
-    return movie_ds
+    Nt, ydim, xdim = movie.shape
+
+    if method == 'interpolate':
+        from skimage.transform import rescale
+
+        # same output shape as skimage.transform.rescale
+        shape = (Nt, *np.maximum(np.round(np.array([ydim, xdim]) * scale_factor),
+                                 1).astype(int))
 
-def gaussian_blur(movie, sigma):
+        def func(frames):
+            return rescale(frames, scale = (1, scale_factor, scale_factor),
+                           preserve_range=True)
+
+    elif method == 'block':
+        factor = int(round(1 / scale_factor))
+        if not np.isclose(factor * scale_factor, 1):
+            raise ValueError("Block averaging needs 1/scale_factor to be an integer!")
+        shape = (Nt, ydim // factor, xdim // factor)
+
+        def func(frames):
+            frames = frames[:, :shape[1] * factor, :shape[2] * factor]
+            return frames.reshape(frames.shape[0], shape[1], factor,
+                                  shape[2], factor).mean(axis=(2, 4))
+
+    else:
+        raise ValueError("Downsampling method must be either 'interpolate' or 'block'")
+
+    movie_ds = _check_out(out, shape, dtype)
+
+    return _map_frames(func, movie, movie_ds, n_threads)
+
+@profiled('gaussian_blur')
+def gaussian_blur(movie, sigma, dtype = np.float64, out = None,
+                  n_threads = None):
 
     '''
     Wraps around skimage.filters.gaussian to adhere to SpyBOAT/Fiji
-    axis ordering (Frames, ydim, xdim).
+    axis ordering (Frames, ydim, xdim). The Gaussian filter
+    has zero width along the time axis, the frames get processed
+    in blocks by multiple threads.
 
     Parameters
     ----------
@@ -64,6 +147,14 @@ def gaussian_blur(movie, sigma):
     movie : ndarray with ndim = 3, smoothing is done along the 
                                    last two axis
     sigma : float, standard deviation of the gaussian kernel.
+    dtype : numpy dtype of the output movie, defaults to float64.
+            float32 halves the memory, but slightly changes
+            the transform results.
+    out : ndarray, optional output array with the same shape
+          as *movie*. Can be the (float) *movie* itself
+          for in-place smoothing.
+    n_threads : int, number of threads to use, None means one
+                per CPU
 
     Returns
     -------
@@ -72,15 +163,19 @@ def gaussian_blur(movie, sigma):
     
     '''
 
-    movie_gb = np.zeros( movie.shape )
-    for frame in range(movie.shape[0]):
-        movie_gb[frame,...] = gaussian(movie[frame,...], sigma = sigma,
-                                       preserve_range=True)
+    from skimage.filters import gaussian
+
+    def func(frames):
+        return gaussian(frames, sigma = (0, sigma, sigma),
+                        preserve_range=True)
+
+    movie_gb = _check_out(out, movie.shape, dtype)
 
-    return movie_gb    
+    return _map_frames(func, movie, movie_gb, n_threads)
 
 # --- Masking ---
 
+@profiled('create_static_mask')
 def create_static_mask(movie, frame, threshold):
 
     '''
@@ -115,7 +210,8 @@ def create_static_mask(movie, frame, threshold):
     
     img = movie[frame]
 
-    if threshold == 'Otsu':    
+    if threshold == 'Otsu':
+        from skimage.filters import threshold_otsu
         threshold = threshold_otsu(img)
     elif np.isreal(threshold):
         # take the supplied value
@@ -127,7 +223,88 @@ def create_static_mask(movie, frame, threshold):
     
     return mask
 
-def create_dynamic_mask(movie, threshold):
+# bins of the per-frame histograms for Otsu thresholding
+OTSU_BINS = 256
+
+
+def _otsu_thresholds(frames, nbins = OTSU_BINS):
+
+    '''
+    Otsu threshold of every frame of *frames* (ndim = 2, one frame per
+    row) like `skimage.filters.threshold_otsu` for float images: the
+    histograms with *nbins* bins spanning the range of each frame
+    get computed in one batched pass, from which the thresholds
+    maximizing the between class variance follow for all frames at once.
+    For integer images skimage counts every single value instead,
+    the thresholds then can differ by up to a bin width.
+    '''
+
+    # bounds the temporaries to a few times the size of a block
+    block = 8 * FRAMES_PER_TASK
+    if frames.shape[0] > block:
+        return np.concatenate([_otsu_thresholds(frames[start:start + block],
+                                                nbins)
+                               for start in range(0, frames.shape[0], block)])
+
+    frames = frames.astype(float, copy=False)
+    Nframes = frames.shape[0]
+    low = frames.min(axis=1)
+    high = frames.max(axis=1)
+    width = (high - low) / nbins
+    # constant frames
+    flat = width == 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bins = ((frames - low[:, None]) / width[:, None])
+    bins = np.clip(np.nan_to_num(bins), 0, nbins - 1).astype(np.intp)
+    # one bincount for all frames
+    bins += np.arange(Nframes)[:, None] * nbins
+    hist = np.bincount(bins.ravel(),
+                       minlength=Nframes * nbins).reshape(Nframes, nbins)
+    centers = low[:, None] + (np.arange(nbins) + 0.5) * width[:, None]
+
+    # class probabilities and means for all possible thresholds
+    weight1 = np.cumsum(hist, axis=1)
+    weight2 = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = np.cumsum(hist * centers, axis=1) / weight1
+        mean2 = (np.cumsum((hist * centers)[:, ::-1], axis=1) /
+                 weight2[:, ::-1])[:, ::-1]
+
+    variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:])**2
+    idx = np.argmax(np.nan_to_num(variance12), axis=1)
+    thresholds = centers[np.arange(Nframes), idx]
+
+    return np.where(flat, low, thresholds)
+
+
+def frame_thresholds(movie, threshold, percentile = None):
+
+    '''
+    The masking threshold of every frame of the *movie*,
+    see `create_dynamic_mask`.
+
+    Returns
+    -------
+
+    thresholds : ndarray with shape (NFrames,)
+    '''
+
+    frames = np.asarray(movie).reshape(movie.shape[0], -1)
+
+    if isinstance(threshold, str) and threshold == 'Otsu':
+        return _otsu_thresholds(frames)
+    elif isinstance(threshold, str) and threshold == 'percentile':
+        if percentile is None:
+            raise ValueError("Percentile thresholding needs a percentile!")
+        return np.percentile(frames, percentile, axis=1)
+    elif not isinstance(threshold, str) and np.isreal(threshold):
+        return np.full(movie.shape[0], threshold, dtype=float)
+    raise ValueError("Masking threshold must be either a float, 'Otsu' or 'percentile'")
+
+
+@profiled('create_dynamic_mask')
+def create_dynamic_mask(movie, threshold, percentile = None, packed = False):
 
     '''
     Creates a boolean mask for every frame of an input
@@ -147,34 +324,150 @@ def create_dynamic_mask(movie, threshold):
                 minimal intensity of a pixel to be considered
                 as foreground . If 'Otsu' uses automatic Otsu
                 thresholding, for each frame individually.
+                If 'percentile' the *percentile* of the intensities
+                of each frame is the threshold.
+    percentile : float in [0, 100], needed for *threshold* 'percentile'
+    packed : bool, return the mask as `PackedMask`, which needs
+             8 times less memory. Default is False.
 
     Returns
     -------
 
-    mask : boolean array with ndim = 3, holds True for masked pixels
+    mask : boolean array with ndim = 3, holds True for masked pixels,
+           or the respective `PackedMask`
     
     '''
 
-    mask = np.zeros(movie.shape, dtype = bool)
+    thresholds = frame_thresholds(movie, threshold, percentile)
 
-    for frame, img in enumerate(movie):
-        img = movie[frame]
+    if not packed:
+        return movie < thresholds[:, None, None]
 
-        if threshold == 'Otsu':    
-            threshold = threshold_otsu(img)
-        elif np.isreal(threshold):
-            # take the supplied value
-            pass
-        else:
-            raise ValueError("Masking threshold must be either a float or 'Otsu'")
-    
+    # pack block-wise, so the full boolean mask never exists
+    packed_bits = np.empty(((movie.shape[0] + 7) // 8, *movie.shape[1:]),
+                           dtype=np.uint8)
+    block = 8 * FRAMES_PER_TASK
+    for start in range(0, movie.shape[0], block):
+        stop = start + block
+        packed_bits[start // 8 : (stop + 7) // 8] = np.packbits(
+            movie[start:stop] < thresholds[start:stop, None, None], axis=0)
 
-        mask[frame] = img < threshold
-    
-    return mask
+    return PackedMask(packed_bits, movie.shape)
+
+
+class PackedMask:
+
+    '''
+    A dynamic mask with shape (NFrames, Y, X) stored as bits packed
+    along time, which needs 8 times less memory than the
+    boolean mask. Can be used like a boolean mask for masking and the
+    transforms (see `spyboat.processing.run_parallel`), only the
+    indexed parts get unpacked, e.g. the spatial tiles
+    of the workers.
+
+    Parameters
+    ----------
+
+    bits : uint8 ndarray with shape (ceil(NFrames / 8), Y, X), the
+           mask as packed by `np.packbits(mask, axis=0)`
+    shape : tuple, the shape (NFrames, Y, X) of the mask
+    '''
+
+    def __init__(self, bits, shape):
+
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.ndim = 3
+        self.dtype = np.dtype(bool)
+
+    @classmethod
+    def from_mask(cls, mask):
+        return cls(np.packbits(mask, axis=0), mask.shape)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def unpack(self):
+
+        ''' The boolean mask '''
+
+        return self[...]
+
+    def __array__(self, dtype = None, copy = None):
+
+        mask = self.unpack()
+        return mask if dtype is None else mask.astype(dtype)
+
+    def __getitem__(self, index):
+
+        # spatial indices directly apply to the packed bits
+        if not isinstance(index, tuple):
+            index = (index,)
+        if index and index[0] is Ellipsis and len(index) == 1:
+            index = ()
+        frames = index[0] if index else slice(None)
+        spatial = index[1:]
+
+        mask = np.unpackbits(self.bits[(slice(None), *spatial)], axis=0,
+                             count=self.shape[0]).view(bool)
+        return mask[frames]
+
+    def all(self, axis = None):
+
+        if axis != 0:
+            return self.unpack().all(axis=axis)
+
+        # all full bytes set, and all bits of the last one
+        Nfull = self.shape[0] // 8
+        res = (self.bits[:Nfull] == 255).all(axis=0)
+        rest = self.shape[0] % 8
+        if rest:
+            last = np.uint8((0xff << (8 - rest)) & 0xff)
+            res &= (self.bits[Nfull] & last) == last
+        return res
+
+    def to_rle(self):
+
+        '''
+        Run-length encoding of the mask, the runs go along the time axis
+        of each pixel, with the pixels in (Y, X) order. The
+        mask of a long recording with stable foreground
+        takes only a few runs per pixel.
+
+        Returns
+        -------
+
+        runs : int ndarray with shape (Nruns, 2), start and length of
+               the masked runs in the flattened (Y, X, NFrames) mask
+        '''
+
+        flat = np.moveaxis(self.unpack(), 0, -1).ravel()
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], flat, [False]))))
+        starts, stops = edges[::2], edges[1::2]
+
+        return np.stack([starts, stops - starts], axis=1)
+
+    @classmethod
+    def from_rle(cls, runs, shape):
+
+        ''' The mask of the *runs* (see `to_rle`) with *shape* '''
+
+        Nframes, ydim, xdim = shape
+        # +1 at the starts, -1 after the ends of the runs
+        marks = np.zeros(Nframes * ydim * xdim + 1, dtype=np.int8)
+        np.add.at(marks, runs[:, 0], 1)
+        np.add.at(marks, runs[:, 0] + runs[:, 1], -1)
+        flat = np.cumsum(marks[:-1], dtype=np.int8).view(bool)
+        mask = np.moveaxis(flat.reshape(ydim, xdim, Nframes), -1, 0)
+
+        return cls.from_mask(mask)
 
+    def __repr__(self):
+        return f'PackedMask(shape={self.shape}, nbytes={self.nbytes})'
 
 
+@profiled('apply_mask')
 def apply_mask(movie, mask, fill_value = -1):
 
     '''
@@ -192,6 +485,8 @@ def apply_mask(movie, mask, fill_value = -1):
     
     '''
 
+    # packed masks get unpacked
+    mask = np.asarray(mask)
 
     # dynamic 3d mask, different for every frame
     if mask.shape == movie.shape: